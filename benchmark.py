@@ -0,0 +1,335 @@
+"""main.py 各阶段的基准测试 (不需要网络，也不需要 Natural Earth 数据)。
+
+用合成的 Shapefile 代替 Natural Earth 底图，用桩地理编码器代替 Nominatim，分别计时:
+缓存读写、启动 (import main 与离线缓存检查)、地理编码 (冷/热缓存)、底图读取与筛选、GeoDataFrame 构建、标签布局、绘图与保存。
+结果以 JSON 输出，便于在不同提交之间比较:
+
+    python benchmark.py -o bench_before.json
+    python benchmark.py -o bench_after.json --quick
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+import matplotlib
+matplotlib.use("Agg")  # 基准测试不需要窗口
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import geopandas
+from shapely.geometry import Polygon, box
+
+import main
+
+# 合成数据的范围与 main.py 的默认显示范围一致
+SYNTHETIC_BOUNDS = (129.0, 30.0, 146.0, 45.5)
+
+
+# --- 合成数据 ---
+def _wiggly_box(x0, y0, x1, y1, vertices_per_side):
+    """边上带正弦起伏的矩形，用来模拟海岸线的顶点密度。"""
+    t = np.linspace(0, 1, vertices_per_side, endpoint=False)
+    wiggle = 0.05 * np.sin(t * 80)
+    coords = np.concatenate([
+        np.column_stack((x0 + (x1 - x0) * t, y0 + wiggle)),
+        np.column_stack((x1 + wiggle, y0 + (y1 - y0) * t)),
+        np.column_stack((x1 - (x1 - x0) * t, y1 + wiggle)),
+        np.column_stack((x0 + wiggle, y1 - (y1 - y0) * t)),
+    ])
+    return Polygon(coords)
+
+def write_synthetic_basemaps(directory, vertices_per_side=2000):
+    """写出与 Natural Earth 列名相同的国家 (ADMIN) 与一级行政区 (adm0_a3) Shapefile，返回两个路径。"""
+    minx, miny, maxx, maxy = SYNTHETIC_BOUNDS
+    countries_path = os.path.join(directory, "countries.shp")
+    geopandas.GeoDataFrame(
+        {'ADMIN': ['Japan', 'South Korea']},
+        geometry=[_wiggly_box(minx, miny, maxx, maxy, vertices_per_side), box(126, 34, 129.5, 38)],
+        crs="EPSG:4326").to_file(countries_path)
+
+    rows = []
+    for x in np.arange(minx, maxx, 2.0):
+        for y in np.arange(miny, maxy, 3.0):
+            rows.append({'adm0_a3': 'JPN', 'name': f"P{len(rows)}",
+                         'geometry': _wiggly_box(x, y, min(x + 2, maxx), min(y + 3, maxy), vertices_per_side // 10)})
+    rows.append({'adm0_a3': 'KOR', 'name': 'K', 'geometry': box(126, 34, 128, 36)})
+    prefectures_path = os.path.join(directory, "admin1.shp")
+    geopandas.GeoDataFrame(rows, crs="EPSG:4326").to_file(prefectures_path)
+    return countries_path, prefectures_path
+
+def synthetic_cities(n, seed=0):
+    """n 个随机城市 (约三分之一为住宿地)，名称长度与真实日文地名相近。"""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = SYNTHETIC_BOUNDS
+    return pd.DataFrame({
+        'name': [f"地点{i}" for i in range(n)],
+        'latitude': rng.uniform(miny, maxy, n),
+        'longitude': rng.uniform(minx, maxx, n),
+        'type': np.where(rng.random(n) < 1 / 3, 'stayed', 'visited'),
+    })
+
+class StubGeocoder:
+    """确定性的离线地理编码器，模拟一次后端查询。"""
+    name = "stub"
+
+    def query_string(self, city_name_japanese):
+        return city_name_japanese
+
+    def geocode(self, city_name_japanese):
+        if city_name_japanese.startswith("不存在"):
+            return None
+        h = zlib.crc32(city_name_japanese.encode('utf-8')) % 10000
+        return (SYNTHETIC_BOUNDS[1] + h / 10000 * 15, SYNTHETIC_BOUNDS[0] + h / 10000 * 17)
+
+
+# --- 计时 ---
+class BenchmarkRecorder:
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.results = []
+
+    def run(self, stage, fn, setup=None, repeat=None, **params):
+        """运行 fn 若干次 (每次之前调用 setup)，记录最短和中位耗时。"""
+        times = []
+        for _ in range(repeat or self.repeat):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+            plt.close('all')
+        result = {'stage': stage, 'params': params, 'repeat': len(times),
+                  'min_seconds': min(times), 'median_seconds': statistics.median(times)}
+        self.results.append(result)
+        param_text = ", ".join(f"{k}={v}" for k, v in params.items())
+        print(f"{stage:<28} {param_text:<32} min {result['min_seconds']:.4f} s  median {result['median_seconds']:.4f} s")
+        return result
+
+
+# --- 各阶段 ---
+def bench_cache(recorder, workdir, n):
+    names = [f"地点{i}" for i in range(n)]
+    legacy = {name: {'latitude': 35.0, 'longitude': 139.0} for name in names}
+    json_path = os.path.join(workdir, "bench_cache.json")
+    with open(json_path, 'w', encoding='utf-8') as f:
+        json.dump(legacy, f, ensure_ascii=False)
+    recorder.run("cache_json_load", lambda: main.load_location_cache(json_path), entries=n)
+
+    db_path = os.path.join(workdir, "bench_cache.sqlite")
+    def reset_db():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    def import_json():
+        main.open_location_cache(db_path, json_path).close()
+    recorder.run("cache_sqlite_import_json", import_json, setup=reset_db, entries=n)
+
+    conn = main.open_location_cache(db_path, False)
+    def store_all():
+        for name in names:
+            main.store_cached_location(conn, name, (35.0, 139.0), name, "bench")
+    def lookup_all():
+        for name in names:
+            main.lookup_cached_location(conn, name)
+    recorder.run("cache_sqlite_store", store_all, entries=n)
+    recorder.run("cache_sqlite_lookup", lookup_all, entries=n)
+    conn.close()
+
+# 只检查/刷新位置缓存的快速路径不应导入这些库
+PLOTTING_MODULES = ("matplotlib", "geopandas", "pandas", "shapely", "adjustText", "geopy")
+
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {main_dir!r})
+import main
+imported = time.perf_counter()
+conn = main.open_location_cache({db_path!r}, False)
+main.check_cities(conn, None, ["地点0", "地点1"])
+conn.close()
+done = time.perf_counter()
+print("STARTUP", imported - start, done - start, ",".join(m for m in {modules!r} if m in sys.modules) or "-")
+"""
+
+def bench_startup(recorder, workdir):
+    """在新的解释器中计时 import main 和离线缓存检查 (--check --offline 的路径)。"""
+    db_path = os.path.join(workdir, "bench_cache.sqlite")  # bench_cache 已写入
+    script = STARTUP_SCRIPT.format(main_dir=os.path.dirname(os.path.abspath(main.__file__)),
+                                   db_path=db_path, modules=PLOTTING_MODULES)
+    import_times, check_times, loaded = [], [], set()
+    for _ in range(recorder.repeat):
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True,
+                                check=True).stdout
+        _, import_seconds, check_seconds, modules = output.strip().splitlines()[-1].split(" ")
+        import_times.append(float(import_seconds))
+        check_times.append(float(check_seconds))
+        loaded.update(m for m in modules.split(",") if m != "-")
+    for stage, times in (("startup_import", import_times), ("startup_check_offline", check_times)):
+        result = {'stage': stage, 'params': {'plotting_modules_loaded': sorted(loaded)}, 'repeat': len(times),
+                  'min_seconds': min(times), 'median_seconds': statistics.median(times)}
+        recorder.results.append(result)
+        print(f"{stage:<28} {'':<32} min {result['min_seconds']:.4f} s  median {result['median_seconds']:.4f} s")
+    if loaded:
+        print(f"警告: 离线缓存检查导入了绘图相关的库: {sorted(loaded)}")
+    return min(check_times), sorted(loaded)
+
+def bench_geocoding(recorder, workdir, n):
+    names = [f"地点{i}" for i in range(n)] + [f"不存在{i}" for i in range(n // 10)]
+    db_path = os.path.join(workdir, "bench_geocode.sqlite")
+    geocoders = [StubGeocoder()]
+
+    def reset_db():
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(db_path + suffix):
+                os.remove(db_path + suffix)
+    def resolve_all():
+        conn = main.open_location_cache(db_path, False)
+        for name in names:
+            main.resolve_city_coordinates(name, conn, geocoders)
+        conn.close()
+    recorder.run("geocode_cold_cache", resolve_all, setup=reset_db, names=len(names))
+    recorder.run("geocode_warm_cache", resolve_all, names=len(names))
+
+def bench_basemap(recorder, workdir, countries_path, prefectures_path):
+    cache_dir = os.path.join(workdir, "basemap_cache")
+    def clear_cache():
+        if os.path.isdir(cache_dir):
+            for file_name in os.listdir(cache_dir):
+                os.remove(os.path.join(cache_dir, file_name))
+    def load_both(tolerance=None):
+        main.load_japan_country_gdf(countries_path, cache_dir=cache_dir, simplify_tolerance=tolerance)
+        main.load_japan_prefectures_gdf(prefectures_path, cache_dir=cache_dir, simplify_tolerance=tolerance)
+    def read_and_filter_uncached():
+        world = geopandas.read_file(countries_path)
+        world[world['ADMIN'] == 'Japan']
+        admin1 = geopandas.read_file(prefectures_path)
+        admin1[admin1['adm0_a3'] == 'JPN']
+    recorder.run("basemap_read_filter_uncached", read_and_filter_uncached)
+    recorder.run("basemap_store_cold", load_both, setup=clear_cache)
+    recorder.run("basemap_store_warm", load_both)
+    tolerance = main.basemap_lod_tolerance()
+    load_both(tolerance)  # 不计时: 先生成简化层级的缓存，下面测的才是热缓存
+    recorder.run("basemap_store_lod_warm", lambda: load_both(tolerance), tolerance=tolerance)
+
+def bench_gdf_construction(recorder, sizes):
+    for n in sizes:
+        cities = synthetic_cities(n)
+        recorder.run("gdf_construction", lambda: main.make_cities_gdf(cities.copy()), cities=n)
+        cities_gdf = main.make_cities_gdf(cities)
+        recorder.run("gdf_projection", lambda: main.project_cities_gdf(cities_gdf), cities=n)
+
+def _labelled_axes(n, font_prop):
+    """建立一个与正式绘图相同尺寸、已画好城市标记的坐标轴。"""
+    cities = main.project_cities_gdf(main.make_cities_gdf(synthetic_cities(n)))
+    fig, ax = plt.subplots(1, 1, figsize=main.MAP_FIGURE_SIZE)
+    main.set_map_view(ax)
+    ax.set_axis_off()
+    plt.tight_layout(pad=0.5)
+    with main.config_overrides({'POINT_CLUSTER_ENABLED': False}):
+        _, marker_points, obstacles_px = main.draw_city_markers(ax, cities, font_prop)
+    return fig, ax, cities, marker_points, obstacles_px
+
+def bench_label_placement(recorder, sizes, adjusttext_max):
+    for n in sizes:
+        state = {}
+        def setup_grid():
+            state['fig'], state['ax'], state['cities'], _, state['obstacles_px'] = _labelled_axes(n, None)
+        recorder.run("labels_grid", lambda: main.draw_city_labels_grid(state['ax'], state['cities'], None,
+                                                                       state['obstacles_px']),
+                     setup=setup_grid, labels=n)
+        if n > adjusttext_max:
+            continue
+        def setup_adjust():
+            state['fig'], state['ax'], state['cities'], state['marker_points'], _ = _labelled_axes(n, None)
+        def run_adjust():
+            # 与正式绘图相同的路径: 初始偏移、adjustText 求解、提取布局记录，再按记录绘制
+            layout = main.layout_city_labels_adjusttext(state['ax'], state['cities'], state['marker_points'], None)
+            main.draw_label_layout(state['ax'], layout, None)
+        recorder.run("labels_adjusttext", run_adjust, setup=setup_adjust, repeat=1, labels=n)
+
+def bench_render(recorder, workdir, countries_path, prefectures_path, dpis, n_cities):
+    cities = main.make_cities_gdf(synthetic_cities(n_cities))
+    output = os.path.join(workdir, "bench_map.png")
+    for static_layer in (False, True):
+        for dpi in dpis:
+            settings = {'MAP_OUTPUT_DPI': dpi, 'LABEL_PLACEMENT_ENGINE': 'grid',
+                        'STATIC_LAYER_CACHE_ENABLED': static_layer}
+            def render():
+                with main.config_overrides(settings):
+                    prefectures = main.load_prefectures_for_map(prefectures_path,
+                                                                simplify_tolerance=main.basemap_lod_tolerance())
+                    main.draw_japan_map_with_cities(countries_path, prefectures, cities, None, output_filename=output)
+            render()  # 预热底图缓存 (以及静态底图图层)，只计时重复渲染
+            recorder.run("draw_and_savefig", render, dpi=dpi, static_layer=static_layer, cities=n_cities)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="main.py 各阶段的基准测试，结果以 JSON 输出。")
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON 结果文件路径")
+    parser.add_argument("--repeat", type=int, default=3, help="每项重复次数 (取最短和中位数)")
+    parser.add_argument("--quick", action="store_true", help="缩小规模 (adjustText 只测 10 个标签，跳过 500 dpi 渲染)")
+    parser.add_argument("--adjusttext-max-labels", type=int, default=1000,
+                        help="adjustText 测试的最大标签数 (100 个以上时每项可能需要数分钟)")
+    parser.add_argument("--max-startup-seconds", type=float, default=None,
+                        help="离线缓存检查 (含 import main) 超过该秒数或导入了绘图库时以状态码 1 退出")
+    args = parser.parse_args()
+
+    label_sizes = [10, 100, 1000]
+    dpis = [100, 200] if args.quick else [100, 200, 500]
+    output_path = os.path.abspath(args.output)
+
+    recorder = BenchmarkRecorder(args.repeat)
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="japan_map_bench_") as workdir:
+        # 模块内的相对路径 (底图缓存、静态图层缓存等) 都落在临时目录中，不影响真实缓存
+        os.chdir(workdir)
+        try:
+            countries_path, prefectures_path = write_synthetic_basemaps(workdir)
+            bench_cache(recorder, workdir, 1000)
+            startup_seconds, startup_modules = bench_startup(recorder, workdir)
+            bench_geocoding(recorder, workdir, 1000)
+            bench_basemap(recorder, workdir, countries_path, prefectures_path)
+            bench_gdf_construction(recorder, [1000, 100000])
+            bench_label_placement(recorder, label_sizes, adjusttext_max=10 if args.quick else args.adjusttext_max_labels)
+            bench_render(recorder, workdir, countries_path, prefectures_path, dpis, n_cities=50)
+        finally:
+            os.chdir(original_cwd)
+
+    report = {
+        'meta': {
+            'git_commit': _git_commit(),
+            'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'versions': {'geopandas': geopandas.__version__, 'matplotlib': matplotlib.__version__,
+                         'numpy': np.__version__, 'pandas': pd.__version__},
+            'repeat': args.repeat,
+            'quick': args.quick,
+            'map_output_crs': main.MAP_OUTPUT_CRS,
+        },
+        'results': recorder.results,
+    }
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"基准测试结果已保存到: {output_path}")
+    if args.max_startup_seconds is not None and (startup_seconds > args.max_startup_seconds or startup_modules):
+        print(f"启动检查未通过: 离线缓存检查耗时 {startup_seconds:.3f} s (上限 {args.max_startup_seconds} s)，"
+              f"导入的绘图库: {startup_modules or '无'}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,15 +1,46 @@
-import geopandas
-import matplotlib.pyplot as plt
-from matplotlib import font_manager # For font handling
-import matplotlib.patheffects as path_effects # For text outline
-from geopy.geocoders import Nominatim
-from geopy.exc import GeocoderTimedOut, GeocoderUnavailable
-from shapely.geometry import Point
 import time
-import pandas as pd
+import numpy as np
 import os
+import sys
 import json
-from adjustText import adjust_text # <--- IMPORT adjustText
+import hashlib
+import contextlib
+import sqlite3
+import math
+import multiprocessing
+import itertools
+import threading
+import collections
+import tempfile
+import shutil
+import http.server
+import socketserver
+import unicodedata
+import datetime
+import importlib
+import functools
+import xml.etree.ElementTree as ElementTree
+
+class _LazyModule:
+    """第一次使用时才真正导入的模块。绘图相关的库导入很慢，只检查/刷新位置缓存时完全不需要。"""
+
+    def __init__(self, module_name):
+        self._module_name = module_name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._module_name)
+        return getattr(self._module, attr)
+
+geopandas = _LazyModule("geopandas")
+plt = _LazyModule("matplotlib.pyplot")
+font_manager = _LazyModule("matplotlib.font_manager") # For font handling
+path_effects = _LazyModule("matplotlib.patheffects") # For text outline
+pd = _LazyModule("pandas")
+pyproj = _LazyModule("pyproj")
+shapely = _LazyModule("shapely")
+# geopy 和 adjustText 在用到它们的函数内导入
 
 # --- 配置 (请根据您的设置修改) ---
 # 1. Shapefile 路径
@@ -37,8 +68,12 @@ HTTPS_PROXY = "http://127.0.0.1:7890"
 # 4. 日文字体设置
 JAPANESE_FONT_NAME = "MS Gothic"
 
-# 5. 位置缓存文件
-LOCATION_CACHE_FILE = "locations_cache.json"
+# 5. 位置缓存
+#    缓存保存在 SQLite 数据库中 (每条结果单独提交，多个进程可同时使用)。
+#    旧版的 JSON 缓存文件会在数据库首次创建时自动导入。
+LOCATION_CACHE_FILE = "locations_cache.json"     # 旧版 JSON 缓存 (仅用于导入)
+LOCATION_CACHE_DB = "locations_cache.sqlite"
+NEGATIVE_CACHE_TTL_DAYS = 7                      # 查询失败的记录保留多少天，期间不再重复请求 API
 
 # 6. 地图样式参数
 BACKGROUND_COLOR = 'white'
@@ -94,31 +129,512 @@ PREFECTURES_EDGE_COLOR = '#b0b0b0'  # 都道府县边界线颜色 (比国家轮
 PREFECTURES_LINEWIDTH = 0.4       # 都道府县边界线线宽
 PREFECTURES_ZORDER = 2            # 确保在国家陆地之上，城市标记之下
 
+# 13. 底图缓存 (裁剪后的国家/都道府县图层)
+#     首次运行时按 MAP_VIEW_XLIM/YLIM (加上边距) 做 bbox 读取和属性筛选，
+#     结果以 GeoParquet 格式保存；之后只要源文件、筛选条件和范围不变，就直接读取缓存。
+BASEMAP_CACHE_DIR = "basemap_cache"  # 设为 None 可禁用缓存，每次都读取原始 Shapefile
+BASEMAP_CLIP_MARGIN = 1.0            # 裁剪范围在显示范围外额外保留的度数，避免裁剪边出现在画面内
+
+# 14. 地理编码后端 (按顺序尝试，前一个找不到时才使用下一个)
+#     "gazetteer": 本地离线地名库，基于 GeoNames 的日本数据 (https://download.geonames.org/export/dump/JP.zip 解压得到 JP.txt)
+#     "nominatim": 在线 API (需要网络/代理，每次请求约 1 秒)
+GEOCODER_BACKENDS = ["gazetteer", "nominatim"]
+GAZETTEER_SOURCE_FILE = "JP.txt"
+GAZETTEER_INDEX_FILE = "gazetteer_jp.sqlite"  # 首次使用时由 GAZETTEER_SOURCE_FILE 生成，源文件更新后自动重建
+
+# 15. 标签布局引擎
+#     "adjusttext": 使用 adjustText 迭代调整 (标签多时很慢，且每次运行结果不同)
+#     "grid":       内置的确定性布局。每个点尝试一组候选位置，用网格空间索引检测碰撞；
+#                   空间不足时优先保留 "住宿过" 的标签，放不下的标签不显示。
+LABEL_PLACEMENT_ENGINE = "adjusttext"
+LABEL_CANDIDATE_RINGS = 3      # "grid" 模式下候选位置的圈数，外圈离点更远并会画引线
+LABEL_MARKER_GAP_PT = 2        # 标签与标记之间的间隙 (磅)
+
+# 16. 输出设置
+MAP_FIGURE_SIZE = (13, 15)     # 图像尺寸 (英寸)
+MAP_OUTPUT_DPI = 500
+DRAFT_OUTPUT_DPI = 72          # 草稿模式 (python main.py --draft) 的分辨率，草稿与正式图共用同一份标签布局
+LABEL_LAYOUT_CACHE_ENABLED = True  # 把标签位置和引线保存到 BASEMAP_CACHE_DIR，城市/字体/范围/图像尺寸不变时直接复用
+
+# 17. 静态底图图层缓存
+#     陆地、国家轮廓和都道府县边界按 (显示范围, 图像尺寸, dpi, 样式, 底图数据) 渲染一次并缓存为 PNG，
+#     之后每次只绘制城市标记、标签和图例，再与缓存的底图合成。
+STATIC_LAYER_CACHE_ENABLED = True
+STATIC_LAYER_OUTPUT_FORMATS = ('.png', '.jpg', '.jpeg', '.webp')  # 其它格式 (如 SVG/PDF) 仍按矢量方式完整绘制
+
+# 18. 底图简化 (LOD)
+#     10m 精度的数据远超输出分辨率。按输出像素大小推算容差，对国家和都道府县图层做拓扑保持的简化
+#     (相邻都道府县的共享边界保持一致)。容差取 2 的整数次幂分级，每级结果都会缓存，草稿和正式渲染各自复用。
+BASEMAP_LOD_ENABLED = True
+BASEMAP_LOD_PIXEL_TOLERANCE = 0.5  # 简化容差 (输出像素)
+
+# 19. 瓦片金字塔导出 (python main.py --tiles [目录])
+#     按 Web 墨卡托 (EPSG:3857) 的 XYZ 规则在日本范围内生成 z/x/y.png 瓦片，多进程并行渲染。
+#     纯海洋的空瓦片不会生成；目录中的 manifest.json 记录每个瓦片的内容指纹，内容未变的瓦片不会重新渲染。
+TILE_OUTPUT_DIR = "tiles"
+TILE_ZOOM_LEVELS = range(4, 10)
+TILE_SIZE = 256        # 瓦片边长 (像素)
+TILE_DPI = 72          # 72 dpi 时 1 磅 = 1 像素，标记和文字大小与在线地图的习惯一致
+TILE_WORKERS = None    # 渲染进程数，None 表示使用全部 CPU 核心
+
+# 20. 批量渲染 (python main.py --batch <目录或清单文件>)
+#     目录中的每个 *.json 是一张地图的配置；清单文件是 {"maps": [配置, ...]}。配置格式:
+#     {
+#         "name": "trip_2024",                      # 可选，默认取文件名
+#         "cities_stayed": ["東京", ...],
+#         "cities_visited": ["京都", ...],
+#         "output": "trip_2024.png",                # 相对路径相对于配置文件所在目录
+#         "settings": {"MAP_VIEW_YLIM": [26, 46], "MAP_LAND_COLOR": "#eeeeee"}   # 可选，覆盖本文件中的大写配置项
+#     }
+#     字体、位置缓存和底图只在主进程加载一次，渲染进程 (fork) 直接共享；单张地图失败不影响其它地图。
+BATCH_WORKERS = None   # 渲染进程数，None 表示使用全部 CPU 核心
+
+# 21. 大量城市点的聚合显示
+#     同一类别的点在某个屏幕网格内超过阈值时，该类别改为按网格聚合: 每个网格画一个标记 (大小随数量增大)
+#     并标注数量；聚合簇内的点不再单独加标签。
+POINT_CLUSTER_ENABLED = True
+POINT_CLUSTER_CELL_PX = 24     # 聚合网格边长 (屏幕像素，按绘图时的 dpi)
+POINT_CLUSTER_THRESHOLD = 5    # 单个网格内同类点超过该数量时启用聚合
+
+# 22. 渲染服务 (python main.py --serve [127.0.0.1:8765 或 unix:/path/to.sock])
+#     常驻进程预先加载字体、位置缓存、地理编码器和底图，渲染进程池在加载完成后 fork，请求无需再付冷启动开销。
+#     POST /render   请求体为 JSON，格式同批量配置 (cities_stayed, cities_visited, settings)，另可指定
+#                    "format": "png"/"jpg"/"pdf"/"svg"；成功时直接返回图片内容。
+#                    settings 只能覆盖样式、显示范围、分辨率和标签引擎相关的配置项 (见 _SERVER_SETTING_RULES)，
+#                    文件路径、缓存目录和字体只能在服务端修改；不合法的取值返回 400。
+#                    城市只从位置缓存和离线地名库解析 (不访问 Nominatim)，有无法解析的城市时返回 400。
+#                    请求的渲染结果不写入 BASEMAP_CACHE_DIR，任意的样式组合不会占满磁盘。
+#     GET /health    运行状态；GET /metrics  请求数、排队数和延迟统计 (JSON)
+SERVER_ADDRESS = "127.0.0.1:8765"
+SERVER_WORKERS = None           # 渲染进程数，None 表示使用全部 CPU 核心
+SERVER_MAX_PENDING = 32         # 同时排队/渲染的请求上限，超过时返回 503
+SERVER_RENDER_TIMEOUT = 300     # 单个请求的渲染超时 (秒)
+SERVER_OUTPUT_FORMATS = {'png': 'image/png', 'jpg': 'image/jpeg', 'pdf': 'application/pdf', 'svg': 'image/svg+xml'}
+SERVER_MAX_OUTPUT_PIXELS = 60_000_000  # 单张图像的像素上限 (MAP_FIGURE_SIZE × MAP_OUTPUT_DPI)，防止请求耗尽内存
+SERVER_MAX_CITIES = 2000        # 单个请求的城市数上限
+SERVER_MAX_ADJUSTTEXT_CITIES = 50  # 使用 adjustText 布局时的城市数上限 (adjustText 的耗时随标签数急剧增长)
+SERVER_MAX_REQUEST_BYTES = 1_000_000  # 请求体大小上限
+
+# 23. 从位置历史导入城市 (python main.py --history track.gpx Records.json ...)
+#     支持 GPX (trkpt/rtept/wpt) 和 Google 位置记录 Records.json ({"locations": [...]})，按流式读取，
+#     大文件也不会整体载入内存。每个定位点吸附到离线地名库 (GAZETTEER_SOURCE_FILE) 中最近的居民点，
+#     在同一地点连续停留且跨过当地凌晨 HISTORY_OVERNIGHT_HOUR 点的记为住宿，停留足够久的记为旅游。
+#     导入结果与 CITIES_STAYED/CITIES_VISITED 合并 (同名时住宿优先)。
+LOCATION_HISTORY_FILES = []
+HISTORY_SNAP_RADIUS_KM = 10          # 定位点到地名的最大吸附距离
+HISTORY_MIN_POPULATION = 1000        # 只吸附到人口不少于该值的居民点
+HISTORY_MAX_ACCURACY_M = 1000        # 忽略精度差于该值的定位点 (仅 Records.json 有精度信息)
+HISTORY_MAX_GAP_HOURS = 12           # 同一地点两个定位点间隔超过该值时视为两次停留
+HISTORY_VISIT_MIN_MINUTES = 30       # 停留至少这么久才算旅游过
+HISTORY_STAY_MIN_HOURS = 3           # 跨过凌晨且停留至少这么久才算住宿
+HISTORY_OVERNIGHT_HOUR = 3           # 当地时间凌晨几点在该地即视为过夜
+HISTORY_UTC_OFFSET_HOURS = 9         # 当地时区 (日本标准时间 UTC+9)
+
+# 24. 都道府县覆盖统计和填色
+#     每个城市通过空间索引归属到都道府县，统计住宿/旅游过的都道府县数量，并检查可疑的坐标:
+#     不在任何都道府县内 (日本以外或海上)，或与预期的都道府县不符。预期的都道府县取自 CITY_EXPECTED_PREFECTURES，
+#     没有指定时取离线地名库中同名地点的 admin1 代码。检查范围包括位置缓存中的全部记录；两者都没有的地点无法核对，
+#     会列为未核对。
+PREFECTURE_CHOROPLETH_ENABLED = True      # 按 住宿/旅游/未到访 填充都道府县颜色
+PREFECTURE_STAYED_FILL_COLOR = '#f5d5c0'
+PREFECTURE_VISITED_FILL_COLOR = '#fbece2'
+PREFECTURE_NAME_COLUMNS = ['name_ja', 'NL_NAME_1', 'name', 'NAME_1']  # 使用第一个存在的列作为都道府县名称
+PREFECTURE_COAST_TOLERANCE = 0.05        # 落在海岸线外这么多度以内的点归到最近的都道府县 (底图精度有限)
+CITY_EXPECTED_PREFECTURES = {            # 已知所在都道府县的城市，用于发现同名地点导致的错误坐标
+    "知床ウトロ": "北海道",
+    "ウトロ": "北海道",                  # 地理编码会返回京都府宇治市的同名地点
+}
+
+# 25. 旅行动画 (python main.py --animate trip.gif)
+#     按 TRIP_ORDER 的顺序逐个显示城市，并画出城市之间的路线。输出格式由扩展名决定:
+#     .mp4/.webm/.gif 在有 ffmpeg 时边渲染边编码；没有 ffmpeg 时 .gif/.png (APNG) 改用 Pillow 编码；
+#     以 '/' 结尾或没有扩展名时输出为 PNG 帧序列目录。
+TRIP_ORDER = []                      # 按访问顺序排列的城市名 (可重复)，为空时按 CITIES_STAYED + CITIES_VISITED 的顺序
+ANIMATION_DPI = 72
+ANIMATION_FPS = 12
+ANIMATION_FRAMES_PER_CITY = 6        # 每段路线用几帧画完
+ANIMATION_HOLD_SECONDS = 2           # 结尾停留时间
+ANIMATION_ROUTE_COLOR = '#d9534f'
+ANIMATION_ROUTE_LINEWIDTH = 1.5
+ANIMATION_WORKERS = None             # 渲染进程数，None 表示使用全部 CPU 核心
+ANIMATION_FRAMES_PER_TASK = 12       # 每个渲染任务连续渲染的帧数
+
+# 26. 输出投影 (地图坐标系)
+#     直接按经纬度 (EPSG:4326) 绘制时，北海道相对九州会被明显拉宽。默认使用以日本为中心的兰伯特等角圆锥投影
+#     (GRS80 椭球，与 JGD2011 一致，单位为米)。MAP_VIEW_XLIM/YLIM 仍按经纬度填写，显示范围会自动换算到投影坐标。
+#     底图图层只在第一次使用某个投影时转换一次，结果按投影缓存在 BASEMAP_CACHE_DIR 中。
+#     其它可选值: "EPSG:4326" (与旧版相同，直接使用经纬度)、
+#     "+proj=aea +lat_0=36 +lon_0=137 +lat_1=33 +lat_2=44 +ellps=GRS80 +units=m +no_defs" (等积圆锥投影)，
+#     或任何 pyproj 能识别的坐标系 (如 "EPSG:6677"，JGD2011 平面直角坐标系第 IX 系)。
+MAP_OUTPUT_CRS = "+proj=lcc +lat_0=36 +lon_0=137 +lat_1=33 +lat_2=44 +ellps=GRS80 +units=m +no_defs"
+
+
+# --- 运行追踪 (分阶段计时，python main.py --trace trace.json) ---
+try:
+    import resource  # Windows 没有此模块，此时不记录内存峰值
+except ImportError:
+    resource = None
+
+_trace_state = {'enabled': False, 'spans': [], 'stack': [], 'counters': {}, 'profile_dir': None,
+                'profiling': False, 'start': None}
+
+def enable_tracing(profile_dir=None):
+    """开启分阶段追踪。指定 profile_dir 时，每个顶层阶段另外保存一份 cProfile 结果 (.prof)。"""
+    _trace_state.update(enabled=True, spans=[], stack=[], counters={}, profile_dir=profile_dir,
+                        profiling=False, start=time.perf_counter())
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # macOS 单位为字节，Linux 为 KB
+
+@contextlib.contextmanager
+def trace_span(name, **attrs):
+    """记录一个阶段的耗时、内存峰值变化和计数器。未开启追踪时几乎没有开销。"""
+    if not _trace_state['enabled']:
+        yield {}
+        return
+    span = {'index': len(_trace_state['spans']), 'name': name, 'depth': len(_trace_state['stack']),
+            'parent': _trace_state['stack'][-1]['index'] if _trace_state['stack'] else None,
+            'attrs': attrs, 'counters': {},
+            'start_seconds': time.perf_counter() - _trace_state['start']}
+    _trace_state['spans'].append(span)
+    _trace_state['stack'].append(span)
+    profiler = None
+    if _trace_state['profile_dir'] and not _trace_state['profiling']:
+        import cProfile
+        profiler = cProfile.Profile()
+        _trace_state['profiling'] = True
+        profiler.enable()
+    rss_before = _peak_rss_mb()
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span['seconds'] = time.perf_counter() - start
+        rss_after = _peak_rss_mb()
+        span['peak_rss_mb'] = rss_after
+        span['peak_rss_delta_mb'] = None if rss_after is None else rss_after - rss_before
+        if profiler is not None:
+            profiler.disable()
+            _trace_state['profiling'] = False
+            profiler.dump_stats(os.path.join(_trace_state['profile_dir'], f"{span['index']:04d}_{name}.prof"))
+        _trace_state['stack'].pop()
+
+def trace_count(counter, n=1):
+    """累加计数器 (当前阶段及其所有上层阶段，以及全局)。"""
+    if not _trace_state['enabled']:
+        return
+    for span in _trace_state['stack']:
+        span['counters'][counter] = span['counters'].get(counter, 0) + n
+    _trace_state['counters'][counter] = _trace_state['counters'].get(counter, 0) + n
+
+def write_trace(path):
+    """把追踪结果写成 JSON，并打印各顶层阶段的耗时摘要。"""
+    trace = {'total_seconds': time.perf_counter() - _trace_state['start'],
+             'peak_rss_mb': _peak_rss_mb(),
+             'counters': _trace_state['counters'],
+             'spans': _trace_state['spans']}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(trace, f, ensure_ascii=False, indent=2, default=str)
+    print("\n各阶段耗时:")
+    for span in _trace_state['spans']:
+        if span['depth'] == 0:
+            delta = span.get('peak_rss_delta_mb')
+            print(f"  {span['name']:<20} {span.get('seconds', 0):8.3f} 秒" +
+                  (f"  内存峰值 +{delta:.1f} MB" if delta else "") +
+                  (f"  {span['counters']}" if span['counters'] else ""))
+    print(f"追踪结果已保存到: {path}")
+
+# --- 输出投影 (经纬度 -> 地图坐标) ---
+@functools.lru_cache(maxsize=16)
+def _crs_info(crs):
+    """返回 (是否为经纬度坐标系, 规范化的 WKT)。解析 CRS 需要查询 PROJ 数据库，结果按 CRS 缓存。"""
+    parsed = pyproj.CRS.from_user_input(crs)
+    return parsed.is_geographic, parsed.to_wkt()
+
+@functools.lru_cache(maxsize=16)
+def _lonlat_transformer(crs, inverse=False):
+    """经纬度 -> crs (inverse 时为 crs -> 经纬度) 的转换器。创建转换器比转换本身慢得多，同一进程内按 CRS 复用。"""
+    if inverse:
+        return pyproj.Transformer.from_crs(crs, "EPSG:4326", always_xy=True)
+    return pyproj.Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+def map_crs_is_lonlat(crs=None):
+    return _crs_info(MAP_OUTPUT_CRS if crs is None else crs)[0]
+
+def project_lonlat(lon, lat, crs=None):
+    """经纬度数组 -> 地图坐标数组 (一次转换全部点)。crs 默认为 MAP_OUTPUT_CRS，经纬度坐标系时原样返回。"""
+    crs = MAP_OUTPUT_CRS if crs is None else crs
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    if map_crs_is_lonlat(crs):
+        return lon, lat
+    return _lonlat_transformer(crs).transform(lon, lat)
+
+def project_cities_gdf(cities_gdf, crs=None):
+    """把城市点图层 (EPSG:4326) 转换到地图坐标系。只替换点坐标，经纬度等其它列保持不变。"""
+    crs = MAP_OUTPUT_CRS if crs is None else crs
+    if map_crs_is_lonlat(crs) or cities_gdf.empty:
+        return cities_gdf
+    x, y = project_lonlat(cities_gdf.geometry.x.to_numpy(), cities_gdf.geometry.y.to_numpy(), crs)
+    return cities_gdf.set_geometry(geopandas.points_from_xy(x, y, crs=crs))
+
+@functools.lru_cache(maxsize=16)
+def _map_view_bounds(crs, xlim, ylim):
+    if map_crs_is_lonlat(crs):
+        return tuple(map(float, xlim)), tuple(map(float, ylim))
+    # 沿经纬度框的四条边加密采样后取外接矩形，投影后弯曲的边界也完整包含在内
+    xmin, ymin, xmax, ymax = _lonlat_transformer(crs).transform_bounds(xlim[0], ylim[0], xlim[1], ylim[1],
+                                                                       densify_pts=50)
+    return (xmin, xmax), (ymin, ymax)
+
+def map_view_bounds(crs=None):
+    """MAP_VIEW_XLIM/YLIM (经纬度) 在地图坐标系中的显示范围，返回 ((xmin, xmax), (ymin, ymax))。"""
+    return _map_view_bounds(MAP_OUTPUT_CRS if crs is None else crs, tuple(MAP_VIEW_XLIM), tuple(MAP_VIEW_YLIM))
+
+def set_map_view(ax):
+    xlim, ylim = map_view_bounds()
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+
+# --- 底图缓存 (裁剪后的国家/都道府县图层) ---
+def _basemap_clip_bbox(crs=None):
+    """返回经纬度 (minx, miny, maxx, maxy)，即显示范围加上 BASEMAP_CLIP_MARGIN。
+
+    使用投影时，投影后的矩形显示范围比经纬度范围更宽 (例如高纬度的两角)，按它反算的经纬度范围裁剪。
+    """
+    crs = MAP_OUTPUT_CRS if crs is None else crs
+    (minx, maxx), (miny, maxy) = MAP_VIEW_XLIM, MAP_VIEW_YLIM
+    if not map_crs_is_lonlat(crs):
+        (x0, x1), (y0, y1) = map_view_bounds(crs)
+        lon0, lat0, lon1, lat1 = _lonlat_transformer(crs, inverse=True).transform_bounds(x0, y0, x1, y1, densify_pts=50)
+        minx, miny, maxx, maxy = min(minx, lon0), min(miny, lat0), max(maxx, lon1), max(maxy, lat1)
+    return (minx - BASEMAP_CLIP_MARGIN, miny - BASEMAP_CLIP_MARGIN,
+            maxx + BASEMAP_CLIP_MARGIN, maxy + BASEMAP_CLIP_MARGIN)
+
+def _basemap_cache_path(cache_dir, source_path, *key_parts):
+    """根据源文件路径、mtime、大小以及其它键 (筛选条件、范围等) 生成缓存文件路径。"""
+    stat = os.stat(source_path)
+    key = repr((os.path.abspath(source_path), stat.st_mtime_ns, stat.st_size) + key_parts)
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(cache_dir, f"{stem}_{digest}.parquet")
+
+def _read_cached_layer(cache_path):
+    if os.path.exists(cache_path):
+        try:
+            return geopandas.read_parquet(cache_path)
+        except Exception as e:
+            print(f"警告: 读取底图缓存 '{cache_path}' 时出错: {e}。将重新生成。")
+    return None
+
+def _write_cached_layer(cache_path, gdf):
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        gdf.to_parquet(tmp_path)
+        os.replace(tmp_path, cache_path)  # 原子替换，避免写入中断留下损坏的缓存
+    except Exception as e:
+        print(f"警告: 保存底图缓存 '{cache_path}' 时出错: {e}")
+
+def basemap_lod_tolerance(dpi=None, figsize=None):
+    """根据输出分辨率推算简化容差 (地图坐标系单位)，并向下取到 2 的整数次幂，使相近的分辨率共用同一级缓存。"""
+    if not BASEMAP_LOD_ENABLED:
+        return None
+    dpi = dpi or MAP_OUTPUT_DPI
+    figsize = figsize or MAP_FIGURE_SIZE
+    # 以整张图的像素数估算 (坐标轴实际更小)，得到的容差偏保守
+    (xmin, xmax), (ymin, ymax) = map_view_bounds()
+    units_per_pixel = min((xmax - xmin) / (figsize[0] * dpi), (ymax - ymin) / (figsize[1] * dpi))
+    return float(2.0 ** np.floor(np.log2(units_per_pixel * BASEMAP_LOD_PIXEL_TOLERANCE)))
+
+def simplify_layer(gdf, tolerance):
+    """拓扑保持的简化。多边形按覆盖 (coverage) 一起简化，相邻多边形的共享边界简化后仍然重合。"""
+    if gdf.empty:
+        return gdf
+    geoms = gdf.geometry.values
+    try:
+        simplified = shapely.coverage_simplify(np.asarray(geoms), tolerance)
+    except Exception as e:  # 旧版 shapely/GEOS 没有 coverage_simplify，或数据不是有效的覆盖
+        print(f"提示: 无法按覆盖简化 ({e})，改为逐个多边形简化，相邻边界可能有细微不一致。")
+        simplified = shapely.simplify(np.asarray(geoms), tolerance, preserve_topology=True)
+    return gdf.set_geometry(geopandas.GeoSeries(simplified, index=gdf.index, crs=gdf.crs))
+
+def load_basemap_layer(source_path, filter_candidates, cache_dir=None, simplify_tolerance=None, crs=None, clip=True):
+    """读取并筛选底图图层，结果按 (源文件, mtime, 筛选条件, 裁剪范围) 缓存。
+
+    filter_candidates 是 [(列名, 值), ...]，使用第一个在数据中存在的列进行筛选；
+    都不存在时不做筛选 (例如 GADM 的日本专用文件)。
+    返回的图层已转换到 crs (默认为 MAP_OUTPUT_CRS)，每个投影单独缓存。
+    指定 simplify_tolerance (crs 的单位) 时返回简化后的图层，每个容差单独缓存。
+    cache_dir 默认为 BASEMAP_CACHE_DIR，传入 False 时不使用缓存。
+    clip=False 时不裁剪到显示范围 (用于都道府县归属等与画面无关的计算)。
+    """
+    crs = MAP_OUTPUT_CRS if crs is None else crs
+    cache_dir = BASEMAP_CACHE_DIR if cache_dir is None else cache_dir
+    with trace_span("basemap_load", source=os.path.basename(source_path), simplify_tolerance=simplify_tolerance):
+        return _load_basemap_layer(source_path, filter_candidates, cache_dir, simplify_tolerance, crs, clip)
+
+def _load_basemap_layer(source_path, filter_candidates, cache_dir, simplify_tolerance, crs, clip):
+    bbox = _basemap_clip_bbox(crs) if clip else None
+    lonlat, crs_wkt = _crs_info(crs)
+    if simplify_tolerance:
+        cache_path = None
+        if cache_dir:
+            cache_path = _basemap_cache_path(cache_dir, source_path, tuple(filter_candidates), bbox,
+                                             ('simplify', simplify_tolerance), *(() if lonlat else (crs_wkt,)))
+            cached_gdf = _read_cached_layer(cache_path)
+            if cached_gdf is not None:
+                print(f"简化后的底图图层已从缓存 '{cache_path}' 加载。")
+                trace_count("basemap_cache_hits")
+                return cached_gdf
+        gdf = load_basemap_layer(source_path, filter_candidates, cache_dir=cache_dir, crs=crs, clip=clip)
+        print(f"正在简化底图图层 (容差 {simplify_tolerance:g} {'度' if lonlat else '投影单位'})...")
+        gdf = simplify_layer(gdf, simplify_tolerance)
+        if cache_path:
+            _write_cached_layer(cache_path, gdf)
+        return gdf
+
+    if not lonlat:
+        # 先裁剪 (经纬度)，再把裁剪后的小图层整体转换到目标投影，结果按投影缓存
+        cache_path = None
+        if cache_dir:
+            cache_path = _basemap_cache_path(cache_dir, source_path, tuple(filter_candidates), bbox, ('crs', crs_wkt))
+            cached_gdf = _read_cached_layer(cache_path)
+            if cached_gdf is not None:
+                print(f"投影后的底图图层已从缓存 '{cache_path}' 加载。")
+                trace_count("basemap_cache_hits")
+                return cached_gdf
+        gdf = _read_clipped_layer(source_path, filter_candidates, cache_dir, bbox)
+        print("正在把底图图层转换到输出投影...")
+        trace_count("basemap_reprojections")
+        gdf = gdf.to_crs(crs)
+        if cache_path:
+            _write_cached_layer(cache_path, gdf)
+        return gdf
+    return _read_clipped_layer(source_path, filter_candidates, cache_dir, bbox)
+
+def _read_clipped_layer(source_path, filter_candidates, cache_dir, bbox):
+    """按经纬度范围 bbox 读取、筛选并裁剪源文件 (不转换坐标系)，结果按裁剪范围缓存。bbox 为 None 时读取全部范围。"""
+    cache_path = None
+    if cache_dir:
+        cache_path = _basemap_cache_path(cache_dir, source_path, tuple(filter_candidates), bbox)
+        cached_gdf = _read_cached_layer(cache_path)
+        if cached_gdf is not None:
+            print(f"底图图层已从缓存 '{cache_path}' 加载。")
+            trace_count("basemap_cache_hits")
+            return cached_gdf
+
+    print(f"正在读取{'并裁剪' if bbox else ''}底图图层: {source_path}")
+    trace_count("basemap_source_reads")
+    gdf = geopandas.read_file(source_path, bbox=bbox)
+    for column, value in filter_candidates:
+        if column in gdf.columns:
+            gdf = gdf[gdf[column] == value]
+            break
+    else:
+        if filter_candidates:
+            print(f"警告: '{source_path}' 中没有可用于筛选的列 {[c for c, _ in filter_candidates]}，将使用全部数据。")
+    if bbox and not gdf.empty:
+        gdf = geopandas.clip(gdf, bbox)
+    gdf = gdf.reset_index(drop=True)
+
+    if cache_path:
+        _write_cached_layer(cache_path, gdf)
+    return gdf
+
+def load_japan_country_gdf(shapefile_path, cache_dir=None, simplify_tolerance=None, crs=None):
+    return load_basemap_layer(shapefile_path, [('ADMIN', 'Japan')], cache_dir=cache_dir,
+                              simplify_tolerance=simplify_tolerance, crs=crs)
+
+def load_japan_prefectures_gdf(prefectures_shapefile_path, cache_dir=None, simplify_tolerance=None, crs=None, clip=True):
+    # Natural Earth 的全球 Admin 1 文件通常有 'adm0_a3' 或 'SOV_A3' 列；
+    # GADM 的日本专用文件 (如 gadm41_JPN_1.shp) 两者都没有，此时直接使用全部数据。
+    return load_basemap_layer(prefectures_shapefile_path, [('adm0_a3', 'JPN'), ('SOV_A3', 'JPN')],
+                              cache_dir=cache_dir, simplify_tolerance=simplify_tolerance, crs=crs, clip=clip)
+
+# --- 位置缓存数据库 (SQLite) ---
+def open_location_cache(db_path=None, legacy_json_path=None):
+    """打开 (必要时创建) 位置缓存数据库 (默认为 LOCATION_CACHE_DB)。
+
+    第一次打开时导入旧版 JSON 缓存 (默认为 LOCATION_CACHE_FILE，传入 False 时不导入)。
+    """
+    db_path = LOCATION_CACHE_DB if db_path is None else db_path
+    legacy_json_path = LOCATION_CACHE_FILE if legacy_json_path is None else legacy_json_path
+    with trace_span("cache_open", db=db_path):
+        return _open_location_cache(db_path, legacy_json_path)
+
+def _open_location_cache(db_path, legacy_json_path):
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")  # 允许多个渲染任务并发读写同一个缓存
+    with conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS locations ("
+                     "name TEXT PRIMARY KEY, latitude REAL, longitude REAL, "
+                     "query TEXT, backend TEXT, updated_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+    imported = conn.execute("SELECT value FROM meta WHERE key = 'legacy_json_imported'").fetchone()
+    if not imported and legacy_json_path and os.path.exists(legacy_json_path):
+        import_location_cache_json(conn, legacy_json_path)
+    return conn
 
-# --- 缓存文件辅助函数 (无变化) ---
 def load_location_cache(cache_file_path):
+    """读取旧版 JSON 位置缓存 ({名称: {latitude, longitude}})，只在一次性导入数据库时使用。"""
     if os.path.exists(cache_file_path):
         try:
             with open(cache_file_path, 'r', encoding='utf-8') as f:
                 cache_data = json.load(f)
-                print(f"位置缓存已从 '{cache_file_path}' 加载。")
+                print(f"旧版位置缓存已从 '{cache_file_path}' 读取。")
                 return cache_data
         except json.JSONDecodeError:
-            print(f"警告: 缓存文件 '{cache_file_path}' 格式错误。将创建新缓存。")
+            print(f"警告: 旧版缓存文件 '{cache_file_path}' 格式错误，跳过导入。")
             return {}
         except Exception as e:
-            print(f"警告: 读取缓存文件 '{cache_file_path}' 时出错: {e}。将创建新缓存。")
+            print(f"警告: 读取旧版缓存文件 '{cache_file_path}' 时出错: {e}。跳过导入。")
             return {}
-    print("未找到缓存文件，将创建新缓存。")
     return {}
 
-def save_location_cache(cache_file_path, cache_data):
-    try:
-        with open(cache_file_path, 'w', encoding='utf-8') as f:
-            json.dump(cache_data, f, ensure_ascii=False, indent=4, sort_keys=True)
-        print(f"位置缓存已保存到 '{cache_file_path}'")
-    except Exception as e:
-        print(f"错误: 保存缓存文件 '{cache_file_path}' 时出错: {e}")
+def import_location_cache_json(conn, json_path):
+    """一次性导入旧版 JSON 缓存。已存在于数据库中的条目不会被覆盖。"""
+    cache_data = load_location_cache(json_path)
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO locations (name, latitude, longitude, query, backend, updated_at) "
+            "VALUES (?, ?, ?, ?, 'legacy_json', ?)",
+            [(name, entry['latitude'], entry['longitude'], name, now)
+             for name, entry in cache_data.items()
+             if isinstance(entry, dict) and 'latitude' in entry and 'longitude' in entry])
+        conn.execute("INSERT OR REPLACE INTO meta VALUES ('legacy_json_imported', ?)", (json_path,))
+    print(f"已将 {len(cache_data)} 条旧版缓存从 '{json_path}' 导入数据库。")
+
+def lookup_cached_location(conn, city_name):
+    """返回 (是否命中, 坐标)。命中失败记录 (未过期) 时返回 (True, None)。"""
+    row = conn.execute("SELECT latitude, longitude, updated_at FROM locations WHERE name = ?",
+                       (city_name,)).fetchone()
+    if row is None:
+        trace_count("cache_misses")
+        return False, None
+    latitude, longitude, updated_at = row
+    if latitude is None or longitude is None:
+        if time.time() - updated_at > NEGATIVE_CACHE_TTL_DAYS * 86400:
+            trace_count("cache_misses")
+            return False, None  # 失败记录已过期，重新查询
+        trace_count("cache_negative_hits")
+        return True, None
+    trace_count("cache_hits")
+    return True, (latitude, longitude)
+
+def store_cached_location(conn, city_name, coords, query, backend):
+    """写入一条缓存 (coords 为 None 表示查询失败)，单独作为一个事务提交。"""
+    latitude, longitude = coords if coords else (None, None)
+    trace_count("cache_writes")
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO locations (name, latitude, longitude, query, backend, updated_at) "
+                     "VALUES (?, ?, ?, ?, ?, ?)",
+                     (city_name, latitude, longitude, query, backend, time.time()))
 
 # --- 辅助函数：获取字体属性 (无变化) ---
 def get_font_properties(font_name_or_path):
@@ -145,20 +661,34 @@ def get_font_properties(font_name_or_path):
     if not fp:
         print("提示: 如果日文显示为方框，请确保正确安装并配置了 'JAPANESE_FONT_NAME'。")
     return fp
-# --- API坐标获取函数 (无变化) ---
-def get_city_coordinates_from_api(city_name_japanese):
-    proxies = {}
-    if HTTP_PROXY: proxies['http'] = HTTP_PROXY
-    if HTTPS_PROXY: proxies['https'] = HTTPS_PROXY # Ensure this proxy URL is correct for HTTPS requests
-    
-    geolocator_user_agent = "japan_map_plotter_v6_proxy" if proxies else "japan_map_plotter_v6_no_proxy"
-    
-    # Handle empty proxies dict for Nominatim
-    current_proxies = proxies if proxies else None
-
-    geolocator = Nominatim(user_agent=geolocator_user_agent, proxies=current_proxies)
-    query = f"{city_name_japanese}, 日本"
+# --- API坐标获取函数 ---
+_nominatim_geolocator = None
+
+def _get_nominatim_geolocator():
+    # 复用同一个 Nominatim 客户端，而不是为每个城市新建一个
+    global _nominatim_geolocator
+    if _nominatim_geolocator is None:
+        proxies = {}
+        if HTTP_PROXY: proxies['http'] = HTTP_PROXY
+        if HTTPS_PROXY: proxies['https'] = HTTPS_PROXY # Ensure this proxy URL is correct for HTTPS requests
+
+        geolocator_user_agent = "japan_map_plotter_v6_proxy" if proxies else "japan_map_plotter_v6_no_proxy"
+
+        # Handle empty proxies dict for Nominatim
+        current_proxies = proxies if proxies else None
+
+        from geopy.geocoders import Nominatim
+        _nominatim_geolocator = Nominatim(user_agent=geolocator_user_agent, proxies=current_proxies)
+    return _nominatim_geolocator
+
+def nominatim_query_string(city_name_japanese):
+    return f"{city_name_japanese}, 日本"
+
+def get_city_coordinates_from_api(city_name_japanese, raise_errors=False):
+    geolocator = _get_nominatim_geolocator()
+    query = nominatim_query_string(city_name_japanese)
     print(f"正在通过 API 获取 '{query}' 的坐标...")
+    trace_count("api_calls")
     try:
         location = geolocator.geocode(query, timeout=15)
         time.sleep(1.1)
@@ -170,189 +700,1454 @@ def get_city_coordinates_from_api(city_name_japanese):
             return None
     except Exception as e:
         print(f"API 获取 '{city_name_japanese}' 位置时发生错误: {e}")
+        if raise_errors:
+            raise
         return None
 
-# --- 主要绘图函数 ---
-def draw_japan_map_with_cities(shapefile_path, prefectures_gdf, all_cities_gdf, font_prop, output_filename="japan_map_with_cities.png"):
+def cached_locations(conn):
+    """返回缓存中所有有坐标的记录 [(名称, 纬度, 经度), ...]。"""
+    return conn.execute("SELECT name, latitude, longitude FROM locations "
+                        "WHERE latitude IS NOT NULL AND longitude IS NOT NULL ORDER BY name").fetchall()
+
+# --- 离线地名库 (GeoNames 日本数据) ---
+def normalize_place_name(name):
+    """地名规范化: NFKC、去空白，并去掉末尾的 市/町/村 (与标签显示的处理一致)。"""
+    name = unicodedata.normalize('NFKC', name).strip().replace(' ', '')
+    if len(name) > 1 and name[-1] in "市町村":
+        name = name[:-1]
+    return name
+
+GAZETTEER_INDEX_VERSION = 2  # 索引表结构变化时加一，旧索引在源文件存在时自动重建
+
+# GeoNames 日本一级行政区代码 (admin1, 按 FIPS 的罗马字顺序编号，冲绳为 47) -> 都道府县名
+GEONAMES_JP_ADMIN1_PREFECTURES = {
+    "01": "愛知県", "02": "秋田県", "03": "青森県", "04": "千葉県", "05": "愛媛県", "06": "福井県",
+    "07": "福岡県", "08": "福島県", "09": "岐阜県", "10": "群馬県", "11": "広島県", "12": "北海道",
+    "13": "兵庫県", "14": "茨城県", "15": "石川県", "16": "岩手県", "17": "香川県", "18": "鹿児島県",
+    "19": "神奈川県", "20": "高知県", "21": "熊本県", "22": "京都府", "23": "三重県", "24": "宮城県",
+    "25": "宮崎県", "26": "長野県", "27": "長崎県", "28": "奈良県", "29": "新潟県", "30": "大分県",
+    "31": "岡山県", "32": "大阪府", "33": "佐賀県", "34": "埼玉県", "35": "滋賀県", "36": "島根県",
+    "37": "静岡県", "38": "栃木県", "39": "徳島県", "40": "東京都", "41": "鳥取県", "42": "富山県",
+    "43": "和歌山県", "44": "山形県", "45": "山口県", "46": "山梨県", "47": "沖縄県",
+}
+
+def build_gazetteer_index(source_path, index_path):
+    """把 GeoNames 格式的 JP.txt 导入 SQLite，并为原名和规范化名称建立索引。保留 admin1 代码用于检查所在都道府县。"""
+    tmp_path = index_path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    print(f"正在从 '{source_path}' 生成离线地名索引 '{index_path}'...")
+    conn = sqlite3.connect(tmp_path)
+    conn.execute("CREATE TABLE places (name TEXT, norm_name TEXT, latitude REAL, longitude REAL, "
+                 "is_populated INTEGER, population INTEGER, admin1 TEXT)")
+
+    def iter_rows():
+        with open(source_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) < 15:
+                    continue
+                latitude, longitude = float(fields[4]), float(fields[5])
+                is_populated = 1 if fields[6] == 'P' else 0
+                population = int(fields[14] or 0)
+                admin1 = fields[10] or None
+                names = {fields[1], fields[2]}
+                names.update(n for n in fields[3].split(',') if n)
+                for name in names:
+                    yield (name, normalize_place_name(name), latitude, longitude, is_populated, population, admin1)
+
+    conn.executemany("INSERT INTO places VALUES (?, ?, ?, ?, ?, ?, ?)", iter_rows())
+    conn.execute("CREATE INDEX places_name ON places (name)")
+    conn.execute("CREATE INDEX places_norm_name ON places (norm_name)")
+    conn.execute("CREATE TABLE meta (source_mtime_ns INTEGER, version INTEGER)")
+    conn.execute("INSERT INTO meta VALUES (?, ?)", (os.stat(source_path).st_mtime_ns, GAZETTEER_INDEX_VERSION))
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, index_path)
+
+class GazetteerGeocoder:
+    """离线地名库后端: 依次尝试 原名精确匹配 -> 规范化名称匹配 -> 前缀匹配。
+
+    同名地点有多个时，优先居民点 (GeoNames feature class 'P')，其次人口多的。
+    """
+    name = "gazetteer"
+
+    def query_string(self, city_name_japanese):
+        return city_name_japanese
+
+    def __init__(self, source_path=None, index_path=None):
+        source_path = GAZETTEER_SOURCE_FILE if source_path is None else source_path
+        index_path = GAZETTEER_INDEX_FILE if index_path is None else index_path
+        if not self._index_is_fresh(source_path, index_path):
+            build_gazetteer_index(source_path, index_path)
+        self.conn = sqlite3.connect(index_path, check_same_thread=False)
+        # 只有旧版索引而没有源文件时无法重建，此时不提供都道府县信息
+        self.has_admin1 = any(column[1] == 'admin1' for column in self.conn.execute("PRAGMA table_info(places)"))
+
+    @staticmethod
+    def _index_is_fresh(source_path, index_path):
+        if not os.path.exists(index_path):
+            return False
+        if not os.path.exists(source_path):
+            return True  # 只有索引没有源文件时，直接使用已有索引
+        try:
+            with sqlite3.connect(index_path) as conn:
+                (source_mtime_ns, version), = conn.execute("SELECT source_mtime_ns, version FROM meta").fetchall()
+        except sqlite3.Error:
+            return False
+        return source_mtime_ns == os.stat(source_path).st_mtime_ns and version == GAZETTEER_INDEX_VERSION
+
+    def _lookup(self, where, params, columns="latitude, longitude"):
+        return self.conn.execute(
+            f"SELECT {columns} FROM places WHERE {where} "
+            "ORDER BY is_populated DESC, population DESC LIMIT 1", params).fetchone()
+
+    def geocode(self, city_name_japanese):
+        norm_name = normalize_place_name(city_name_japanese)
+        if not norm_name:
+            return None
+        # 前缀匹配用范围查询代替 LIKE，以便使用 norm_name 上的索引
+        row = (self._lookup("name = ?", (city_name_japanese,))
+               or self._lookup("norm_name = ?", (norm_name,))
+               or self._lookup("norm_name >= ? AND norm_name < ?", (norm_name, norm_name + '\U0010ffff')))
+        return (row[0], row[1]) if row else None
+
+    def prefecture(self, city_name_japanese):
+        """地名库中同名地点 (与 geocode 的优先顺序相同，但不使用前缀匹配) 所在的都道府县名，未知时返回 None。"""
+        norm_name = normalize_place_name(city_name_japanese)
+        if not self.has_admin1 or not norm_name:
+            return None
+        row = (self._lookup("name = ?", (city_name_japanese,), "admin1")
+               or self._lookup("norm_name = ?", (norm_name,), "admin1"))
+        return GEONAMES_JP_ADMIN1_PREFECTURES.get(row[0]) if row else None
+
+class NominatimGeocoder:
+    """在线 Nominatim 后端，仅作为离线地名库找不到时的后备。"""
+    name = "nominatim"
+
+    def query_string(self, city_name_japanese):
+        return nominatim_query_string(city_name_japanese)
+
+    def geocode(self, city_name_japanese):
+        # 网络错误向上抛出，以免被当作 "地名不存在" 写入失败缓存
+        return get_city_coordinates_from_api(city_name_japanese, raise_errors=True)
+
+def build_geocoders(backend_names=None):
+    """按 GEOCODER_BACKENDS 的顺序创建可用的地理编码后端列表。"""
+    geocoders = []
+    for backend_name in (backend_names if backend_names is not None else GEOCODER_BACKENDS):
+        if backend_name == "gazetteer":
+            if not (os.path.exists(GAZETTEER_SOURCE_FILE) or os.path.exists(GAZETTEER_INDEX_FILE)):
+                print(f"提示: 未找到离线地名数据 '{GAZETTEER_SOURCE_FILE}'，跳过离线地名库。")
+                continue
+            try:
+                geocoders.append(GazetteerGeocoder(GAZETTEER_SOURCE_FILE, GAZETTEER_INDEX_FILE))
+            except Exception as e:
+                print(f"警告: 加载离线地名库时出错: {e}。跳过离线地名库。")
+        elif backend_name == "nominatim":
+            geocoders.append(NominatimGeocoder())
+        else:
+            print(f"警告: 未知的地理编码后端 '{backend_name}'，已忽略。")
+    return geocoders
+
+def geocode_city(city_name_japanese, geocoders):
+    """依次使用各后端查询坐标。
+
+    返回 (坐标, 后端名, 查询字符串, 是否确定失败)。坐标为 None 且 "是否确定失败" 为 False
+    表示有后端出错 (如网络不可用)，这种结果不应写入失败缓存。
+    """
+    all_answered = True
+    for geocoder in geocoders:
+        try:
+            coords = geocoder.geocode(city_name_japanese)
+        except Exception:
+            all_answered = False
+            continue
+        if coords:
+            if geocoder.name != "nominatim":
+                print(f"{geocoder.name} 找到 '{city_name_japanese}': ({coords[0]:.4f}, {coords[1]:.4f})")
+            return coords, geocoder.name, geocoder.query_string(city_name_japanese), False
+    backends = ",".join(geocoder.name for geocoder in geocoders)
+    return None, backends, city_name_japanese, all_answered and bool(geocoders)
+
+def resolve_city_coordinates(city_name_japanese, cache_conn, geocoders):
+    """先查缓存，未命中时地理编码并把结果 (包括确定的失败) 写入缓存。"""
+    found, coords = lookup_cached_location(cache_conn, city_name_japanese)
+    if found:
+        if coords:
+            print(f"从缓存加载 '{city_name_japanese}'。")
+        else:
+            print(f"缓存记录显示 '{city_name_japanese}' 此前查询失败 ({NEGATIVE_CACHE_TTL_DAYS} 天内不再重试)。")
+        return coords
+    with trace_span("geocode", city=city_name_japanese) as span:
+        coords, backend, query, definitely_missing = geocode_city(city_name_japanese, geocoders)
+        span['attrs'] = dict(span.get('attrs', {}), backend=backend, found=coords is not None)
+    if coords or definitely_missing:
+        store_cached_location(cache_conn, city_name_japanese, coords, query, backend)
+    return coords
+
+# --- 只检查/刷新位置缓存 (不导入绘图相关的库) ---
+def configured_city_names():
+    """配置中所有城市名 (去重，保持顺序)。"""
+    return list(dict.fromkeys(list(CITIES_STAYED) + list(CITIES_VISITED)))
+
+def check_cities(location_cache, geocoders=None, city_names=None):
+    """解析并检查城市坐标，不绘图。geocoders 为 None 时只查缓存 (不联网)。返回未能解析的城市列表。"""
+    city_names = city_names if city_names is not None else configured_city_names()
+    unresolved = []
+    for city_name in city_names:
+        if geocoders is None:
+            _, coords = lookup_cached_location(location_cache, city_name)
+        else:
+            coords = resolve_city_coordinates(city_name, location_cache, geocoders)
+        if not coords:
+            unresolved.append(city_name)
+    print(f"\n共 {len(city_names)} 个城市，已解析 {len(city_names) - len(unresolved)} 个。")
+    if unresolved:
+        print(f"未能解析的城市: {unresolved}")
+    return unresolved
+
+def refresh_location_cache(location_cache, geocoders, city_names=None):
+    """重新地理编码城市并覆盖缓存记录 (包括失败记录)。返回坐标发生变化的城市列表。"""
+    city_names = city_names if city_names is not None else configured_city_names()
+    changed, missing = [], []
+    for city_name in city_names:
+        _, old_coords = lookup_cached_location(location_cache, city_name)
+        coords, backend, query, definitely_missing = geocode_city(city_name, geocoders)
+        if not coords and (old_coords or not definitely_missing):
+            # 查询出错，或当前后端找不到但缓存中已有坐标 (可能来自其它后端)，都不覆盖
+            print(f"'{city_name}' 未能重新解析，保留原有缓存记录。")
+            continue
+        store_cached_location(location_cache, city_name, coords, query, backend)
+        if coords is None:
+            # 之前没有坐标，本次仍确认找不到: 只记录为失败，不算坐标变化
+            print(f"'{city_name}' 仍未找到，已记录为查询失败。")
+            missing.append(city_name)
+            continue
+        if old_coords is None or max(abs(coords[0] - old_coords[0]), abs(coords[1] - old_coords[1])) > 0.01:
+            print(f"'{city_name}' 的坐标已更新: {old_coords} -> {coords}")
+            changed.append(city_name)
+    print(f"\n已刷新 {len(city_names)} 个城市，其中 {len(changed)} 个坐标发生变化。")
+    if missing:
+        print(f"以下 {len(missing)} 个城市仍无法解析: {', '.join(missing)}")
+    return changed
+
+# --- 城市点图层 (向量化构建，密集时按网格聚合) ---
+# adjustText 模式下个别城市标签的初始偏移 (经度, 纬度)
+ADJUSTTEXT_INITIAL_OFFSETS = {
+    "関西空港": (0.2, -0.5),
+    "神戸": (-0.7, -0.5),
+    "京都": (-0.3, 0.5),
+    "横浜": (-0.3, 0),
+    "下田市": (-0.5, -0.7),
+    "中標津空港": (0, -0.7),
+    "野付": (0, -0.7),
+    "釧路": (0, -0.7),
+}
+
+def make_cities_gdf(cities_df):
+    """由含 name/latitude/longitude/type 列的 DataFrame 一次性构建点图层 (不逐行创建 Point)。"""
+    geometry = geopandas.points_from_xy(cities_df['longitude'], cities_df['latitude'])
+    return geopandas.GeoDataFrame(cities_df, geometry=geometry, crs="EPSG:4326")
+
+def cluster_points_on_grid(points_px, cell_px):
+    """把点按屏幕网格分组。返回 (每个点所属组的编号, 各组数量, 各组中心)。"""
+    cells = np.floor(points_px / cell_px).astype(np.int64)
+    _, inverse, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    centers = np.column_stack((np.bincount(inverse, weights=points_px[:, 0]),
+                               np.bincount(inverse, weights=points_px[:, 1]))) / counts[:, None]
+    return inverse, counts, centers
+
+def draw_city_markers(ax, all_cities_gdf, font_prop):
+    """每个类别只绘制一个散点集合，点数多少都一样。
+
+    需要在设置好坐标范围和版式 (tight_layout) 之后调用，聚合网格 POINT_CLUSTER_CELL_PX 才与最终图像的像素一致。
+    返回 (需要加标签的城市, {类别: 实际绘制的标记坐标 (M, 2)}, 障碍物 (K, 4))。
+    障碍物是所有已绘制的标记 (包括聚合圆和不加标签的点) 及聚合数量文字的像素框 (x0, y0, x1, y1)，标签布局时避开。
+    """
+    styles = city_label_styles()
+    ax.apply_aspect()  # 按固定纵横比收缩后的坐标轴位置才是最终的像素位置
+    px_per_pt = ax.figure.dpi / 72.0
+    marker_points = {}
+    obstacles, count_texts = [], []
+    keep_for_labels = np.ones(len(all_cities_gdf), dtype=bool)
+    types = all_cities_gdf['type'].to_numpy()
+    xy = np.column_stack((all_cities_gdf.geometry.x.to_numpy(), all_cities_gdf.geometry.y.to_numpy())).reshape(-1, 2)
+    for city_type, (marker, face, edge, lw, size, zorder, legend_label) in city_marker_styles().items():
+        mask = types == city_type
+        points = xy[mask]
+        marker_points[city_type] = points
+        if len(points) == 0:
+            continue
+        sizes = size
+        if POINT_CLUSTER_ENABLED and len(points) > POINT_CLUSTER_THRESHOLD:
+            inverse, counts, centers_px = cluster_points_on_grid(ax.transData.transform(points), POINT_CLUSTER_CELL_PX)
+            if counts.max() > POINT_CLUSTER_THRESHOLD:
+                print(f"{legend_label}: {len(points)} 个点过于密集，聚合为 {len(counts)} 个网格。")
+                points = ax.transData.inverted().transform(centers_px)
+                marker_points[city_type] = points
+                sizes = size * (1 + np.log2(counts))  # 面积随数量对数增长
+                keep_for_labels[np.flatnonzero(mask)[counts[inverse] > 1]] = False
+                fontsize, color, effects, _, _, _ = styles[city_type]
+                count_font = _label_font_properties(font_prop, fontsize * 0.8)
+                for (x, y), count in zip(points[counts > 1], counts[counts > 1]):
+                    count_texts.append(ax.text(x, y, str(count), fontproperties=count_font, color=color,
+                                               path_effects=effects, ha='center', va='center', zorder=zorder + 0.5))
+        ax.scatter(points[:, 0], points[:, 1], marker=marker, facecolors=face, edgecolors=edge,
+                   linewidths=lw, s=sizes, zorder=zorder, label=legend_label)
+        # 标记的 s 是面积 (pt²)，半径为边长的一半再加上半个线宽
+        radii = (np.sqrt(np.broadcast_to(sizes, (len(points),))) + lw) / 2 * px_per_pt
+        points_px = ax.transData.transform(points)
+        obstacles.append(np.column_stack((points_px - radii[:, None], points_px + radii[:, None])))
+    if count_texts:
+        renderer = ax.figure.canvas.get_renderer()
+        obstacles.append(np.array([text.get_window_extent(renderer).extents for text in count_texts]))
+    obstacles = np.concatenate(obstacles) if obstacles else np.zeros((0, 4))
+    return all_cities_gdf[keep_for_labels], marker_points, obstacles
+
+# --- 标签布局 (网格空间索引，确定性) ---
+# 8 个候选方向，按优先顺序: 右、右上、上、左上、左、左下、下、右下
+_LABEL_DIRECTIONS = np.array([(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)], dtype=float)
+
+def label_display_name(name):
+    return name.replace("市", "").replace("町", "").replace("村", "")
+
+def _boxes_overlap(candidates, boxes):
+    """candidates (K, 4) 与 boxes (M, 4) 两两是否相交，返回 (K,) 布尔数组。框格式为 (x0, y0, x1, y1)。"""
+    if len(boxes) == 0:
+        return np.zeros(len(candidates), dtype=bool)
+    c = candidates[:, None, :]
+    b = boxes[None, :, :]
+    hit = (c[..., 0] < b[..., 2]) & (c[..., 2] > b[..., 0]) & (c[..., 1] < b[..., 3]) & (c[..., 3] > b[..., 1])
+    return hit.any(axis=1)
+
+class _BoxGrid:
+    """把矩形按所覆盖的网格单元分桶，用于快速找出某区域附近已占用的矩形。"""
+
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.boxes = []
+
+    def _cell_range(self, box):
+        x0, y0, x1, y1 = (np.floor(np.asarray(box) / self.cell_size)).astype(int)
+        return range(x0, x1 + 1), range(y0, y1 + 1)
+
+    def insert(self, box):
+        index = len(self.boxes)
+        self.boxes.append(box)
+        xs, ys = self._cell_range(box)
+        for cx in xs:
+            for cy in ys:
+                self.cells.setdefault((cx, cy), []).append(index)
+
+    def query(self, box):
+        xs, ys = self._cell_range(box)
+        indices = set()
+        for cx in xs:
+            for cy in ys:
+                indices.update(self.cells.get((cx, cy), ()))
+        return np.array([self.boxes[i] for i in sorted(indices)]).reshape(-1, 4)
+
+def place_labels(points_px, sizes_px, priorities, marker_radii_px, bounds_px, gap_px, rings=None, obstacles_px=None):
+    """计算标签位置 (像素坐标)。
+
+    points_px: (N, 2) 点的位置；sizes_px: (N, 2) 标签宽高；priorities: (N,) 数值越小越先放置；
+    marker_radii_px: (N,) 标记半径 (同时作为障碍物)；bounds_px: 允许放置的区域 (x0, y0, x1, y1)。
+    返回 (lower_left (N, 2), ring (N,))，ring 为 -1 表示没有放下。结果只取决于输入，不含随机性。
+    rings 默认为 LABEL_CANDIDATE_RINGS。obstacles_px: (K, 4) 其它需要避开的框 (x0, y0, x1, y1)，如不加标签的标记。
+    """
+    rings = LABEL_CANDIDATE_RINGS if rings is None else rings
+    points_px = np.asarray(points_px, dtype=float).reshape(-1, 2)
+    sizes_px = np.asarray(sizes_px, dtype=float).reshape(-1, 2)
+    marker_radii_px = np.broadcast_to(np.asarray(marker_radii_px, dtype=float), (len(points_px),))
+    n = len(points_px)
+    lower_left = np.full((n, 2), np.nan)
+    placed_ring = np.full(n, -1, dtype=int)
+    if n == 0:
+        return lower_left, placed_ring
+
+    grid = _BoxGrid(cell_size=max(float(np.median(sizes_px[:, 0])), 1.0))
+    for (x, y), r in zip(points_px, marker_radii_px):
+        grid.insert((x - r, y - r, x + r, y + r))
+    for box in (() if obstacles_px is None else np.asarray(obstacles_px, dtype=float).reshape(-1, 4)):
+        grid.insert(tuple(box))
+
+    unit = _LABEL_DIRECTIONS / np.linalg.norm(_LABEL_DIRECTIONS, axis=1)[:, None]
+    bx0, by0, bx1, by1 = bounds_px
+    for i in np.lexsort((np.arange(n), np.asarray(priorities))):
+        (x, y), (w, h) = points_px[i], sizes_px[i]
+        # 每圈 8 个候选，圈与圈之间相隔一个标签高度
+        distances = marker_radii_px[i] + gap_px + h * np.arange(rings)
+        anchors = (np.array([x, y]) + distances[:, None, None] * unit[None, :, :]).reshape(-1, 2)
+        dirs = np.tile(_LABEL_DIRECTIONS, (rings, 1))
+        x0 = anchors[:, 0] - w * (1 - dirs[:, 0]) / 2
+        y0 = anchors[:, 1] - h * (1 - dirs[:, 1]) / 2
+        candidates = np.column_stack((x0, y0, x0 + w, y0 + h))
+        inside = (candidates[:, 0] >= bx0) & (candidates[:, 1] >= by0) & (candidates[:, 2] <= bx1) & (candidates[:, 3] <= by1)
+        search_area = (candidates[:, 0].min(), candidates[:, 1].min(), candidates[:, 2].max(), candidates[:, 3].max())
+        free = inside & ~_boxes_overlap(candidates, grid.query(search_area))
+        if free.any():
+            k = int(np.argmax(free))
+            lower_left[i] = candidates[k, :2]
+            placed_ring[i] = k // len(_LABEL_DIRECTIONS)
+            grid.insert(tuple(candidates[k]))
+    return lower_left, placed_ring
+
+def _label_font_properties(font_prop, fontsize):
+    fp = font_prop.copy() if font_prop else font_manager.FontProperties()
+    fp.set_size(fontsize)
+    return fp
+
+def city_label_styles():
+    """每种城市类型的标签样式: (字号, 颜色, 描边效果, 描边宽度, 标记大小, 布局优先级)。"""
+    return {
+        'stayed': (STAYED_CITY_LABEL_FONTSIZE, STAYED_CITY_LABEL_COLOR,
+                   [path_effects.Stroke(linewidth=STAYED_CITY_LABEL_OUTLINE_WIDTH, foreground=STAYED_CITY_LABEL_OUTLINE_COLOR),
+                    path_effects.Normal()],
+                   STAYED_CITY_LABEL_OUTLINE_WIDTH, STAYED_CITY_MARKER_SIZE, 0),
+        'visited': (VISITED_CITY_LABEL_FONTSIZE, VISITED_CITY_LABEL_COLOR,
+                    [path_effects.Stroke(linewidth=VISITED_CITY_LABEL_OUTLINE_WIDTH, foreground=VISITED_CITY_LABEL_OUTLINE_COLOR),
+                     path_effects.Normal()],
+                    VISITED_CITY_LABEL_OUTLINE_WIDTH, VISITED_CITY_MARKER_SIZE, 1),
+    }
+
+def city_label_styles_key():
+    """标签样式中影响渲染结果的部分 (用于缓存键)。"""
+    return tuple((city_type, fontsize, color, outline_width, marker_size)
+                 for city_type, (fontsize, color, _, outline_width, marker_size, _) in sorted(city_label_styles().items()))
+
+def city_marker_styles():
+    """每种城市类型的标记样式: (形状, 填充色, 边框色, 线宽, 大小, zorder, 图例文字)，按绘制顺序排列。"""
+    return {
+        'visited': (VISITED_CITY_MARKER_SHAPE, VISITED_CITY_MARKER_FACE_COLOR, VISITED_CITY_MARKER_EDGE_COLOR,
+                    VISITED_CITY_MARKER_LINEWIDTH, VISITED_CITY_MARKER_SIZE, VISITED_CITY_MARKER_ZORDER, '旅行した'),
+        'stayed': ('o', STAYED_CITY_MARKER_FACE_COLOR, STAYED_CITY_MARKER_EDGE_COLOR,
+                   STAYED_CITY_MARKER_LINEWIDTH, STAYED_CITY_MARKER_SIZE, STAYED_CITY_MARKER_ZORDER, '滞在した'),
+    }
+
+def city_marker_styles_key():
+    """标记样式 (用于缓存键)。"""
+    return tuple(city_marker_styles().items())
+
+def measure_label_sizes(renderer, dpi, names, types, font_prop, styles):
+    """测量标签宽高 (像素，包含描边)。每种 (文字, 字号) 只测量一次。返回 (sizes (N, 2), 各字号的 FontProperties)。"""
+    px_per_pt = dpi / 72.0
+    font_cache = {}
+    extent_cache = {}
+    sizes_px = np.empty((len(names), 2))
+    for i, (name, city_type) in enumerate(zip(names, types)):
+        fontsize, _, _, outline_width, _, _ = styles[city_type]
+        key = (name, fontsize)
+        if key not in extent_cache:
+            if fontsize not in font_cache:
+                font_cache[fontsize] = _label_font_properties(font_prop, fontsize)
+            w, h, _ = renderer.get_text_width_height_descent(name, font_cache[fontsize], ismath=False)
+            extent_cache[key] = (w + outline_width * px_per_pt, h + outline_width * px_per_pt)
+        sizes_px[i] = extent_cache[key]
+    return sizes_px, font_cache
+
+def layout_city_labels_grid(ax, all_cities_gdf, font_prop, obstacles_px=None):
+    """用 place_labels 计算标签布局，返回布局记录 (见 draw_label_layout)。需要在设置好坐标范围和版式之后调用。
+    obstacles_px 为 draw_city_markers 返回的障碍物，标签不会压在这些标记和数量文字上。"""
+    fig = ax.figure
+    renderer = fig.canvas.get_renderer()
+    px_per_pt = fig.dpi / 72.0
+
+    styles = city_label_styles()
+    label_types = ['stayed'] + (['visited'] if VISITED_CITY_LABEL_ENABLED else [])
+    labelled = all_cities_gdf[all_cities_gdf['type'].isin(label_types)]
+    if labelled.empty:
+        return []
+    print(f"正在使用内置网格布局放置 {len(labelled)} 个标签...")
+
+    names = [label_display_name(name) for name in labelled['name']]
+    types = labelled['type'].to_numpy()
+    points_px = ax.transData.transform(np.column_stack((labelled.geometry.x, labelled.geometry.y)))
+    sizes_px, _ = measure_label_sizes(renderer, fig.dpi, names, types, font_prop, styles)
+
+    marker_radii_px = np.array([np.sqrt(styles[t][4]) / 2 * px_per_pt for t in types])
+    priorities = np.array([styles[t][5] for t in types])
+    lower_left, rings = place_labels(points_px, sizes_px, priorities, marker_radii_px,
+                                     ax.bbox.extents, LABEL_MARKER_GAP_PT * px_per_pt, obstacles_px=obstacles_px)
+
+    placed = rings >= 0
+    to_data = ax.transData.inverted()
+    lower_left_data = to_data.transform(np.nan_to_num(lower_left))
+    layout = []
+    for i in np.flatnonzero(placed):
+        leader = None
+        if rings[i] > 0:
+            # 外圈标签画一条引线连到标签框最近的点
+            box_center = lower_left[i] + sizes_px[i] / 2
+            nearest = np.clip(points_px[i], lower_left[i], lower_left[i] + sizes_px[i])
+            if np.allclose(nearest, points_px[i]):
+                nearest = box_center
+            leader = ['line', *to_data.transform([points_px[i], nearest]).ravel().tolist()]
+        layout.append({'text': names[i], 'type': types[i], 'x': float(lower_left_data[i, 0]),
+                       'y': float(lower_left_data[i, 1]), 'ha': 'left', 'va': 'bottom', 'leader': leader})
+
+    dropped = int((~placed).sum())
+    if dropped:
+        print(f"空间不足，有 {dropped} 个标签未显示 (优先保留住宿地标签)。")
+    print("标签布局完成。")
+    return layout
+
+def draw_city_labels_grid(ax, all_cities_gdf, font_prop, obstacles_px=None):
+    """用 place_labels 布局并绘制城市标签，返回显示的标签数。"""
+    layout = layout_city_labels_grid(ax, all_cities_gdf, font_prop, obstacles_px)
+    draw_label_layout(ax, layout, font_prop)
+    return len(layout)
+
+ADJUSTTEXT_ARROWPROPS = dict(arrowstyle="-", color='grey', lw=1, alpha=1, zorder=3.5)
+
+def layout_city_labels_adjusttext(ax, labelable_gdf, marker_points, font_prop):
+    """用 adjustText 迭代调整标签位置，返回布局记录。求解用的临时文本和引线在返回前移除。"""
+    from adjustText import adjust_text
+    styles = city_label_styles()
+    label_types = ['stayed'] + (['visited'] if VISITED_CITY_LABEL_ENABLED else [])
+    labelled = labelable_gdf[labelable_gdf['type'].isin(label_types)]
+    target_x = labelled.geometry.x.to_numpy() # 记录原始位置
+    target_y = labelled.geometry.y.to_numpy()
+    # 初始偏移量 (经度, 纬度) - adjustText 会以此为起点进行调整，个别城市使用经验值；换算到地图坐标
+    offsets = np.array([ADJUSTTEXT_INITIAL_OFFSETS.get(name, (0, 0)) for name in labelled['name']],
+                       dtype=float).reshape(-1, 2)
+    start_x, start_y = project_lonlat(labelled['longitude'].to_numpy() + offsets[:, 0],
+                                      labelled['latitude'].to_numpy() + offsets[:, 1])
+
+    # 添加城市标签 (将文本对象收集到列表中)
+    texts_to_adjust = []
+    for name, city_type, x, y in zip(labelled['name'], labelled['type'], start_x, start_y):
+        fontsize, color, effects, _, _, _ = styles[city_type]
+        texts_to_adjust.append(ax.text(x, y, label_display_name(name),
+                                       fontsize=fontsize,
+                                       color=color,
+                                       fontproperties=font_prop,
+                                       path_effects=effects,
+                                       ha='left', va='bottom',
+                                       zorder=STAYED_CITY_LABEL_ZORDER))
+    if not texts_to_adjust:
+        return []
+
+    # 调用 adjust_text 进行标签调整
+    print(f"正在使用 adjustText 调整 {len(texts_to_adjust)} 个标签位置以减少重叠...")
+    # 传入所有标记的坐标，帮助 adjustText 避免标签覆盖标记
+    point_types = ['visited'] if VISITED_CITY_LABEL_ENABLED else []
+    points_for_adjusttext = np.concatenate([marker_points[t] for t in point_types + ['stayed']])
+
+    _, arrows = adjust_text(texts_to_adjust,
+                            x=points_for_adjusttext[:, 0], # 提供原始点坐标，帮助 adjustText 避免覆盖点
+                            y=points_for_adjusttext[:, 1],
+                            target_x=target_x,
+                            target_y=target_y,
+                            objects=ax.collections, # 考虑已绘制的散点图集合
+                            expand=(1.3, 1.3),
+                            pull_threshold=10,
+                            only_move={"text": "xy", "static": "xy", "explode": "xy", "pull": "xy"},
+                            force_static=5,         # 点对文本的排斥力
+                            force_text=5,            # 文本之间的排斥力
+                            force_pull=0.00 ,
+                            force_explode=0,
+                            iter_lim=5000,                   # 最大迭代次数
+                            arrowprops=ADJUSTTEXT_ARROWPROPS # 可选：箭头
+                           )
+    print("adjustText 完成。")
+
+    # adjustText 把文本改为居中对齐放在最终位置，并只为离目标足够远的文本画引线
+    arrow_texts = {id(getattr(arrow, 'patchA', None) or arrow.arrow_patch.patchA) for arrow in arrows}
+    layout = []
+    for text, city_type, x, y in zip(texts_to_adjust, labelled['type'], target_x, target_y):
+        text_x, text_y = text.get_position()
+        layout.append({'text': text.get_text(), 'type': city_type, 'x': float(text_x), 'y': float(text_y),
+                       'ha': 'center', 'va': 'center',
+                       'leader': ['arrow', float(x), float(y)] if id(text) in arrow_texts else None})
+    for artist in texts_to_adjust + list(arrows):
+        artist.remove()
+    return layout
+
+def draw_label_layout(ax, layout, font_prop):
+    """按布局记录绘制标签和引线，返回标签文本对象列表。记录为 {'text', 'type', 'x', 'y', 'ha', 'va', 'leader'} (数据坐标)，
+    leader 为 None、['line', x0, y0, x1, y1] (直线) 或 ['arrow', 目标x, 目标y] (从标签边缘到目标的连线)。"""
+    from matplotlib.collections import LineCollection
+    from matplotlib.patches import FancyArrowPatch
+    styles = city_label_styles()
+    font_cache = {}
+    leader_segments = []
+    texts = []
+    for entry in layout:
+        fontsize, color, effects, _, _, _ = styles[entry['type']]
+        if fontsize not in font_cache:
+            font_cache[fontsize] = _label_font_properties(font_prop, fontsize)
+        text = ax.text(entry['x'], entry['y'], entry['text'],
+                       fontsize=fontsize, color=color, fontproperties=font_cache[fontsize],
+                       path_effects=effects, ha=entry['ha'], va=entry['va'],
+                       zorder=STAYED_CITY_LABEL_ZORDER)
+        texts.append(text)
+        leader = entry['leader']
+        if leader and leader[0] == 'line':
+            leader_segments.append([leader[1:3], leader[3:5]])
+        elif leader and leader[0] == 'arrow':
+            ax.add_patch(FancyArrowPatch(posA=(entry['x'], entry['y']), posB=tuple(leader[1:3]), patchA=text,
+                                         transform=ax.transData, **ADJUSTTEXT_ARROWPROPS))
+    if leader_segments:
+        ax.add_collection(LineCollection(leader_segments, colors='grey', linewidths=1, zorder=3.5))
+    return texts
+
+def label_layout_cache_key(labelable_gdf, marker_points, font_prop):
+    """标签布局缓存键: 引擎、城市名称/类型/坐标、标记位置、字体和字号、显示范围、图像尺寸。不含 dpi，草稿和正式图共用。"""
+    font_key = None if font_prop is None else (font_prop.get_file(), tuple(font_prop.get_family()))
+    coords = np.column_stack((labelable_gdf.geometry.x, labelable_gdf.geometry.y)).reshape(-1, 2)
+    key = repr((LABEL_PLACEMENT_ENGINE, list(labelable_gdf['name']), list(labelable_gdf['type']),
+                np.round(coords, 7).tolist(),
+                {t: np.round(p, 7).tolist() for t, p in sorted(marker_points.items())},
+                font_key, city_label_styles_key(), city_marker_styles_key(), VISITED_CITY_LABEL_ENABLED,
+                map_view_bounds(), tuple(MAP_FIGURE_SIZE),
+                LABEL_CANDIDATE_RINGS, LABEL_MARKER_GAP_PT, sorted(ADJUSTTEXT_INITIAL_OFFSETS.items())))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def load_label_layout(cache_key, cache_dir=None):
+    cache_dir = BASEMAP_CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir:
+        return None
+    cache_path = os.path.join(cache_dir, f"label_layout_{cache_key}.json")
+    if not os.path.exists(cache_path):
+        return None
     try:
-        world_gdf = geopandas.read_file(shapefile_path)
-        japan_gdf = world_gdf[world_gdf['ADMIN'] == 'Japan']
-        if japan_gdf.empty:
-            print("错误: 未能在国家 Shapefile 中找到 'Japan' 的数据。")
-            return
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            layout = json.load(f)
+        print(f"标签布局已从缓存 '{cache_path}' 加载，跳过布局计算。")
+        return layout
+    except Exception as e:
+        print(f"警告: 读取标签布局缓存 '{cache_path}' 时出错: {e}。将重新计算。")
+        return None
 
-        fig, ax = plt.subplots(1, 1, figsize=(13, 15))
-        fig.patch.set_facecolor(BACKGROUND_COLOR)
-        ax.set_facecolor(BACKGROUND_COLOR)
+def save_label_layout(cache_key, layout, cache_dir=None):
+    cache_dir = BASEMAP_CACHE_DIR if cache_dir is None else cache_dir
+    if not cache_dir:
+        return
+    cache_path = os.path.join(cache_dir, f"label_layout_{cache_key}.json")
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = cache_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(layout, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_path)
+    except Exception as e:
+        print(f"警告: 保存标签布局缓存 '{cache_path}' 时出错: {e}")
+
+# --- 都道府县覆盖统计 ---
+_prefecture_join_memory_cache = {}
+
+def assign_prefectures(cities_gdf, prefectures_gdf, cache_dir=None):
+    """返回每个城市所在都道府县在 prefectures_gdf 中的位置 (不在任何都道府县内时为 -1)。
+
+    用 STRtree (查询时使用预处理几何) 批量判断包含关系，结果按 (都道府县图层, 城市坐标) 缓存
+    (cache_dir 默认为 BASEMAP_CACHE_DIR，传入 False 时只使用进程内缓存)。
+    """
+    cache_dir = BASEMAP_CACHE_DIR if cache_dir is None else cache_dir
+    coords = np.ascontiguousarray(cities_gdf[['longitude', 'latitude']].to_numpy(dtype=float))
+    coast_tolerance = PREFECTURE_COAST_TOLERANCE
+    if prefectures_gdf.crs is not None and not prefectures_gdf.crs.is_geographic:
+        # 都道府县图层已投影: 城市坐标按同一投影转换，容差按每度纬度约 111 km 换算
+        coords = np.ascontiguousarray(np.column_stack(project_lonlat(coords[:, 0], coords[:, 1], prefectures_gdf.crs)))
+        coast_tolerance = PREFECTURE_COAST_TOLERANCE * 111320 / prefectures_gdf.crs.axis_info[0].unit_conversion_factor
+    digest = hashlib.sha1((_gdf_fingerprint(prefectures_gdf) + repr(coast_tolerance)).encode('utf-8') +
+                          coords.tobytes()).hexdigest()[:16]
+    assignment = _prefecture_join_memory_cache.get(digest)
+    if assignment is not None:
+        return assignment
+    cache_path = os.path.join(cache_dir, f"prefecture_join_{digest}.npy") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            assignment = np.load(cache_path)
+        except Exception as e:
+            print(f"警告: 读取都道府县归属缓存 '{cache_path}' 时出错: {e}。将重新计算。")
+    if assignment is None or len(assignment) != len(coords):
+        points = shapely.points(coords)
+        tree = shapely.STRtree(prefectures_gdf.geometry.to_numpy())
+        assignment = np.full(len(coords), -1, dtype=np.int64)
+        point_index, prefecture_index = tree.query(points, predicate='intersects')
+        # 恰好落在边界上的点会匹配两个都道府县，保留第一个
+        point_index, first = np.unique(point_index, return_index=True)
+        assignment[point_index] = prefecture_index[first]
+        missing = np.flatnonzero(assignment < 0)
+        if len(missing) and coast_tolerance:
+            point_index, prefecture_index = tree.query_nearest(points[missing], max_distance=coast_tolerance,
+                                                               all_matches=False)
+            assignment[missing[point_index]] = prefecture_index
+        if cache_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = cache_path + ".tmp.npy"
+                np.save(tmp_path, assignment)
+                os.replace(tmp_path, cache_path)
+            except Exception as e:
+                print(f"警告: 保存都道府县归属缓存 '{cache_path}' 时出错: {e}")
+    if len(_prefecture_join_memory_cache) >= 8:
+        _prefecture_join_memory_cache.clear()
+    _prefecture_join_memory_cache[digest] = assignment
+    return assignment
+
+def prefecture_names(prefectures_gdf):
+    for column in PREFECTURE_NAME_COLUMNS:
+        if column in prefectures_gdf.columns:
+            return prefectures_gdf[column].astype(str).to_numpy()
+    return np.array([f"#{i}" for i in range(len(prefectures_gdf))])
+
+def _normalize_prefecture_name(name):
+    name = unicodedata.normalize('NFKC', name).strip()
+    return name[:-1] if len(name) > 2 and name[-1] in "都府県" else name
+
+def prefecture_visit_status(cities_gdf, prefectures_gdf):
+    """每个都道府县的到访状态: 'stayed' / 'visited' / None (与 prefectures_gdf 的行对应)。"""
+    if cities_gdf is None or cities_gdf.empty:
+        return np.full(len(prefectures_gdf), None, dtype=object)
+    return _visit_status_from_assignment(assign_prefectures(cities_gdf, prefectures_gdf),
+                                         cities_gdf['type'].to_numpy(), len(prefectures_gdf))
+
+def _visit_status_from_assignment(assignment, city_types, prefecture_count):
+    """由城市的都道府县归属和类型得到各都道府县的到访状态 (住宿优先于旅游)。"""
+    status = np.full(prefecture_count, None, dtype=object)
+    inside = assignment >= 0
+    status[np.unique(assignment[inside & (city_types == 'visited')])] = 'visited'
+    status[np.unique(assignment[inside & (city_types == 'stayed')])] = 'stayed'
+    return status
+
+def report_prefecture_coverage(cities_gdf, prefectures_gdf, cached_locations=None, gazetteer=None):
+    """打印都道府县覆盖统计，并返回可疑坐标列表 [(地名, 原因), ...]。
+
+    prefectures_gdf 应为未裁剪的图层 (见 load_prefectures_for_map 的 clip 参数)，否则显示范围外的城市
+    (如冲绳) 会被当作日本以外。坐标检查除 cities_gdf 外还包括位置缓存中的记录 cached_locations。
+    """
+    if cities_gdf is None or cities_gdf.empty or prefectures_gdf is None or prefectures_gdf.empty:
+        return []
+    names = prefecture_names(prefectures_gdf)
+    status = prefecture_visit_status(cities_gdf, prefectures_gdf)
+    stayed, visited = names[status == 'stayed'], names[status == 'visited']
+    print(f"\n都道府县覆盖: 住宿 {len(stayed)} 个，仅旅游 {len(visited)} 个，"
+          f"未到访 {len(names) - len(stayed) - len(visited)} 个 (共 {len(names)} 个)。")
+    if len(stayed):
+        print(f"  住宿: {'、'.join(stayed)}")
+    if len(visited):
+        print(f"  旅游: {'、'.join(visited)}")
+
+    locations = cities_gdf[['name', 'latitude', 'longitude']]
+    if cached_locations:
+        locations = pd.concat([locations, pd.DataFrame(cached_locations, columns=['name', 'latitude', 'longitude'])],
+                              ignore_index=True).drop_duplicates('name')
+    suspicious, unverified = find_suspicious_locations(locations, prefectures_gdf, gazetteer)
+    for name, reason in suspicious:
+        print(f"警告: '{name}' 的坐标可疑: {reason}。请检查位置缓存或改用更具体的地名。")
+    if unverified:
+        print(f"提示: {len(unverified)} 个地点没有预期的都道府县 (CITY_EXPECTED_PREFECTURES 或离线地名库)，"
+              f"无法核对是否误取了同名地点: {'、'.join(unverified)}")
+    return suspicious
+
+def find_suspicious_locations(locations, prefectures_gdf, gazetteer=None):
+    """检查 locations (含 name/latitude/longitude 列) 中不在任何都道府县内，或不在预期都道府县内的地点。
+
+    预期的都道府县优先取 CITY_EXPECTED_PREFECTURES，其次取离线地名库中同名地点的 admin1 代码。
+    图层中没有对应名称 (例如只有英文名称列) 时不做这项检查。
+    返回 (可疑地点 [(地名, 原因), ...], 没有预期都道府县而无法核对的地名列表)。
+    """
+    assignment = assign_prefectures(locations, prefectures_gdf)
+    names = prefecture_names(prefectures_gdf)
+    known = {_normalize_prefecture_name(name) for name in names}
+    suspicious, unverified = [], []
+    for name, prefecture in zip(locations['name'], assignment):
+        if prefecture < 0:
+            suspicious.append((name, "不在任何都道府县内 (可能在日本以外)"))
+            continue
+        expected = CITY_EXPECTED_PREFECTURES.get(name)
+        source = "应在"
+        if not expected and gazetteer is not None:
+            expected, source = gazetteer.prefecture(name), "离线地名库中的同名地点在"
+        if not expected or _normalize_prefecture_name(expected) not in known:
+            unverified.append(name)
+        elif _normalize_prefecture_name(names[prefecture]) != _normalize_prefecture_name(expected):
+            suspicious.append((name, f"位于 {names[prefecture]}，但{source} {expected}"))
+    return suspicious, unverified
+
+# --- 静态底图图层 (渲染一次，缓存为位图) ---
+_static_layer_memory_cache = {}  # 同一进程内重复渲染时直接复用，避免重复解码 PNG
 
-        
-
-        # 用于 adjustText 的点列表 (marker的中心)
-        points_for_adjusttext = []
-        # 用于 adjustText 的文本对象列表
-        texts_to_adjust = []
-
-        # 筛选并绘制 "仅旅游过" (VISITED) 的城市标记
-        visited_cities_gdf = all_cities_gdf[all_cities_gdf['type'] == 'visited']
-        if not visited_cities_gdf.empty:
-            visited_cities_gdf.plot(ax=ax, marker=VISITED_CITY_MARKER_SHAPE,
-                                    facecolors=VISITED_CITY_MARKER_FACE_COLOR,
-                                    edgecolors=VISITED_CITY_MARKER_EDGE_COLOR,
-                                    linewidths=VISITED_CITY_MARKER_LINEWIDTH,
-                                    markersize=VISITED_CITY_MARKER_SIZE,
-                                    zorder=VISITED_CITY_MARKER_ZORDER,
-                                    label='旅行した')
-            if VISITED_CITY_LABEL_ENABLED:
-                for idx, row in visited_cities_gdf.iterrows():
-                    points_for_adjusttext.append(row.geometry) # 添加点本身
-
-        # 筛选并绘制 "住宿过" (STAYED) 的城市标记
-        stayed_cities_gdf = all_cities_gdf[all_cities_gdf['type'] == 'stayed']
-        if not stayed_cities_gdf.empty:
-            stayed_cities_gdf.plot(ax=ax, marker='o',
-                                   facecolors=STAYED_CITY_MARKER_FACE_COLOR,
-                                   edgecolors=STAYED_CITY_MARKER_EDGE_COLOR,
-                                   linewidths=STAYED_CITY_MARKER_LINEWIDTH,
-                                   markersize=STAYED_CITY_MARKER_SIZE,
-                                   zorder=STAYED_CITY_MARKER_ZORDER,
-                                   label='滞在した')
-            for idx, row in stayed_cities_gdf.iterrows():
-                points_for_adjusttext.append(row.geometry) # 添加点本身
-
-
-        # 添加城市标签 (将文本对象收集到列表中)
-        text_path_effects_stayed = [
-            path_effects.Stroke(linewidth=STAYED_CITY_LABEL_OUTLINE_WIDTH, foreground=STAYED_CITY_LABEL_OUTLINE_COLOR),
-            path_effects.Normal()
-        ]
-        text_path_effects_visited = [
-            path_effects.Stroke(linewidth=VISITED_CITY_LABEL_OUTLINE_WIDTH, foreground=VISITED_CITY_LABEL_OUTLINE_COLOR),
-            path_effects.Normal()
-        ]
-
-        original_locations = []
-
-        for idx, row in all_cities_gdf.iterrows():
-            name = row['name']
-            name_display = name.replace("市", "").replace("町", "").replace("村", "")
-            
-            # 初始偏移量 (dx, dy) - adjustText 会以此为起点进行调整
-            # 这些可以设为较小的值，或根据经验初步设定
-            dx, dy = 0, 0 # 统一的较小初始偏移
-            
-            # # (可选) 您仍然可以保留一些非常特定的初始偏移，如果需要的话
-            if name == "関西空港": dx = 0.2; dy = -0.5
-            elif name == "神戸": dx = -0.7; dy = -0.5
-            elif name == "京都": dx = -0.3; dy = 0.5
-            elif name == "横浜": dx = -0.3; dy = 0
-            elif name == "下田市": dx = -0.5; dy = -0.7
-            elif name in ["中標津空港", "野付", "釧路"]: dx = 0; dy = -0.7
-
-            original_locations.append(row.geometry) # 记录原始位置
-
-            text_obj = None
-            if row['type'] == 'stayed':
-                text_obj = ax.text(row.geometry.x + dx, row.geometry.y + dy, name_display,
-                                   fontsize=STAYED_CITY_LABEL_FONTSIZE,
-                                   color=STAYED_CITY_LABEL_COLOR,
-                                   fontproperties=font_prop,
-                                   path_effects=text_path_effects_stayed,
-                                   ha='left', va='bottom',
-                                   zorder=STAYED_CITY_LABEL_ZORDER)
-            elif row['type'] == 'visited' and VISITED_CITY_LABEL_ENABLED:
-                text_obj = ax.text(row.geometry.x + dx, row.geometry.y + dy, name_display, # 使用相同的初始dx,dy
-                                   fontsize=VISITED_CITY_LABEL_FONTSIZE,
-                                   color=VISITED_CITY_LABEL_COLOR,
-                                   fontproperties=font_prop,
-                                   path_effects=text_path_effects_visited,
-                                   ha='left', va='bottom',
-                                   zorder=STAYED_CITY_LABEL_ZORDER)
-            if text_obj:
-                texts_to_adjust.append(text_obj)
-        
-        # 调用 adjust_text 进行标签调整
-        if texts_to_adjust:
-            print(f"正在使用 adjustText 调整 {len(texts_to_adjust)} 个标签位置以减少重叠...")
-            # adjust_text 需要 x, y 坐标作为参考点，但我们已经把Text对象初步放置了。
-            # 它会尝试调整这些Text对象。
-            # 如果标签与点（marker）重叠，可以传递点的坐标给 `add_objects` 或通过 `x`, `y` 参数（如果Text对象没有预先放置）
-            # 这里，我们让它调整已有的Text对象，并可以告诉它哪些点是它们不应覆盖的。
-            # `points_for_adjusttext` 包含所有标记的 GeoPandas Point 对象
-            
-            # 从GeoPandas Point对象中提取x, y坐标列表
-            x_points = [p.x for p in points_for_adjusttext]
-            y_points = [p.y for p in points_for_adjusttext]
-
-            target_x = [p.x for p in original_locations]
-            target_y = [p.y for p in original_locations]
-
-            adjust_text(texts_to_adjust,
-                        x=x_points, # 提供原始点坐标，帮助 adjustText 避免覆盖点
-                        y=y_points,
-                        target_x=target_x,
-                        target_y=target_y,
-                        objects=ax.collections, # 考虑已绘制的散点图集合 (ax.collections包含plot()产生的PathCollection)
-                        expand=(1.3, 1.3),
-                        pull_threshold=10,
-                        only_move={"text": "xy", "static": "xy", "explode": "xy", "pull": "xy"},
-                        force_static=5,         # 点对文本的排斥力
-                        force_text=5,            # 文本之间的排斥力
-                        force_pull=0.00 ,
-                        force_explode=0,
-                        iter_lim=5000,                   # 最大迭代次数
-                        arrowprops=dict(arrowstyle="-", color='grey', lw=1, alpha=1, zorder=3.5) # 可选：箭头
-                       )
-            print("adjustText 完成。")
-
-        # 1. 绘制日本国家轮廓 (zorder=1)
+def _geographic_aspect(gdf):
+    """与 geopandas 的 aspect='auto' 相同: 地理坐标系为 1 / cos(中心纬度)，投影坐标系为 1。"""
+    if gdf.crs is not None and not gdf.crs.is_geographic:
+        return 1.0
+    miny, maxy = gdf.total_bounds[1], gdf.total_bounds[3]
+    return 1 / np.cos(np.radians((miny + maxy) / 2))
+
+def _gdf_fingerprint(gdf):
+    if gdf is None or gdf.empty:
+        return None
+    return hashlib.sha1(b"".join(gdf.geometry.to_wkb())).hexdigest()
+
+def plot_basemap_layers(ax, japan_gdf, prefectures_gdf, verbose=True):
+    """绘制陆地/国家轮廓 (zorder=1) 和都道府县边界 (zorder=2)。每个图层单独记录追踪阶段。"""
+    # 1. 绘制日本国家轮廓 (zorder=1)
+    with trace_span("basemap_country", geometries=len(japan_gdf)):
         japan_gdf.plot(ax=ax, edgecolor=MAP_OUTLINE_COLOR, facecolor=MAP_LAND_COLOR,
-                       linewidth=MAP_OUTLINE_LINEWIDTH, zorder=1)
+                       linewidth=MAP_OUTLINE_LINEWIDTH, zorder=1, aspect=None)
 
-        # 2. 绘制都道府县边界 (zorder=2)
-        if prefectures_gdf is not None and not prefectures_gdf.empty:
+    # 2. 绘制都道府县边界 (zorder=2)，有到访状态时先按状态填色
+    if prefectures_gdf is not None and not prefectures_gdf.empty:
+        if verbose:
             print(f"正在绘制 {len(prefectures_gdf)} 个都道府县的边界...")
+        if 'visit_status' in prefectures_gdf.columns:
+            with trace_span("basemap_prefecture_fill", geometries=int(prefectures_gdf['visit_status'].notna().sum())):
+                for status, color in (('visited', PREFECTURE_VISITED_FILL_COLOR), ('stayed', PREFECTURE_STAYED_FILL_COLOR)):
+                    filled = prefectures_gdf[prefectures_gdf['visit_status'] == status]
+                    if not filled.empty:
+                        filled.plot(ax=ax, facecolor=color, edgecolor='none', linewidth=0,
+                                    zorder=(1 + PREFECTURES_ZORDER) / 2, aspect=None)
+        with trace_span("basemap_prefecture_edges", geometries=len(prefectures_gdf)):
             prefectures_gdf.plot(ax=ax,
                                  edgecolor=PREFECTURES_EDGE_COLOR,
                                  facecolor='none', # 通常不填充内部边界的颜色
                                  linewidth=PREFECTURES_LINEWIDTH,
-                                 zorder=PREFECTURES_ZORDER)
-        elif prefectures_gdf is None:
-            print("提示: 未提供都道府县数据文件路径，将跳过绘制都道府县边界。")
-        else: # empty GeoDataFrame
-            print("警告: 都道府县数据为空，无法绘制边界。")
+                                 zorder=PREFECTURES_ZORDER,
+                                 aspect=None)
+    elif not verbose:
+        pass
+    elif prefectures_gdf is None:
+        print("提示: 未提供都道府县数据文件路径，将跳过绘制都道府县边界。")
+    else: # empty GeoDataFrame
+        print("警告: 都道府县数据为空，无法绘制边界。")
+
+def render_static_basemap_layer(fig_size_inches, axes_bounds, dpi, japan_gdf, prefectures_gdf, verbose=True):
+    """渲染整张图的静态底图 (背景色 + 陆地/轮廓/都道府县)，坐标轴位置与目标图完全一致。返回 RGBA 数组。"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=fig_size_inches, dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_facecolor(BACKGROUND_COLOR)
+    ax = fig.add_axes(axes_bounds)
+    ax.set_axis_off()
+    plot_basemap_layers(ax, japan_gdf, prefectures_gdf, verbose=verbose)
+    ax.set_aspect('auto')  # axes_bounds 已是目标图按纵横比调整后的实际位置
+    set_map_view(ax)
+    with trace_span("basemap_rasterize"):
+        canvas.draw()
+    return np.asarray(canvas.buffer_rgba()).copy()
+
+def get_static_basemap_layer(fig_size_inches, axes_bounds, dpi, japan_gdf, prefectures_gdf, cache_dir=None, verbose=True):
+    """取得静态底图位图: 先查进程内缓存，再查磁盘 PNG 缓存 (默认在 BASEMAP_CACHE_DIR)，都没有时渲染并写入缓存。"""
+    cache_dir = BASEMAP_CACHE_DIR if cache_dir is None else cache_dir
+    from PIL import Image
+    style = (BACKGROUND_COLOR, MAP_LAND_COLOR, MAP_OUTLINE_COLOR, MAP_OUTLINE_LINEWIDTH,
+             PREFECTURES_EDGE_COLOR, PREFECTURES_LINEWIDTH, PREFECTURE_STAYED_FILL_COLOR, PREFECTURE_VISITED_FILL_COLOR,
+             tuple(prefectures_gdf['visit_status']) if prefectures_gdf is not None and 'visit_status' in prefectures_gdf.columns
+             else None)
+    key = repr((map_view_bounds(), tuple(np.round(fig_size_inches, 4)),
+                tuple(np.round(axes_bounds, 6)), dpi, style,
+                _gdf_fingerprint(japan_gdf), _gdf_fingerprint(prefectures_gdf)))
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+    layer = _static_layer_memory_cache.get(digest)
+    if layer is not None:
+        return layer
+    cache_path = os.path.join(cache_dir, f"static_layer_{digest}.png") if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            layer = np.asarray(Image.open(cache_path).convert('RGBA'))
+            print(f"静态底图图层已从缓存 '{cache_path}' 加载。")
+        except Exception as e:
+            print(f"警告: 读取静态底图缓存 '{cache_path}' 时出错: {e}。将重新渲染。")
+    if layer is None:
+        print("正在渲染静态底图图层...")
+        trace_count("static_layer_renders")
+        with trace_span("plot_basemap", static_layer=True):
+            layer = render_static_basemap_layer(fig_size_inches, axes_bounds, dpi, japan_gdf, prefectures_gdf, verbose)
+        if cache_path:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = cache_path + ".tmp.png"
+                Image.fromarray(layer).save(tmp_path, compress_level=1)
+                os.replace(tmp_path, cache_path)
+            except Exception as e:
+                print(f"警告: 保存静态底图缓存 '{cache_path}' 时出错: {e}")
+    _static_layer_memory_cache.clear()  # 只保留最近一次使用的图层，限制内存占用
+    _static_layer_memory_cache[digest] = layer
+    return layer
+
+def save_composited_map(fig, ax, japan_gdf, prefectures_gdf, output_filename, dpi):
+    """只渲染 fig 中的动态图层 (透明背景)，再叠加到缓存的静态底图上保存。需要在版式确定后调用。"""
+    from PIL import Image
+    ax.apply_aspect()
+    axes_bounds = ax.get_position().bounds
+    base = get_static_basemap_layer(tuple(fig.get_size_inches()), axes_bounds, dpi, japan_gdf, prefectures_gdf)
 
+    original_dpi = fig.dpi
+    fig.patch.set_alpha(0)
+    ax.patch.set_alpha(0)
+    try:
+        fig.set_dpi(dpi)
+        fig.canvas.draw()
+        overlay = Image.frombuffer('RGBA', fig.canvas.get_width_height(), fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+    finally:
+        fig.set_dpi(original_dpi)
+        fig.patch.set_alpha(1)
+        ax.patch.set_alpha(1)
+
+    image = Image.fromarray(base)
+    image.alpha_composite(overlay)
+    if image.getextrema()[3][0] == 255 or os.path.splitext(output_filename)[1].lower() in ('.jpg', '.jpeg'):
+        image = image.convert('RGB')  # 背景不透明时去掉 alpha 通道，编码更快、文件更小
+    image.save(output_filename, dpi=(dpi, dpi))
+
+# --- 多进程渲染 ---
+def _process_pool(initializer, initargs, workers):
+    """创建渲染进程池。fork 可用时子进程直接共享父进程已加载的数据，否则通过 initializer 传入 initargs。"""
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    return context.Pool(processes=workers, initializer=initializer, initargs=initargs)
+
+# --- 瓦片金字塔导出 (Web 墨卡托 XYZ) ---
+_EARTH_RADIUS = 6378137.0
+_MERCATOR_HALF_WORLD = math.pi * _EARTH_RADIUS
+_tile_worker_state = None  # 每个渲染进程预加载的底图/城市/标签数据
+
+def lonlat_to_mercator(lon, lat):
+    """经纬度 -> EPSG:3857 坐标 (向量化)。"""
+    lon = np.asarray(lon, dtype=float)
+    lat = np.clip(np.asarray(lat, dtype=float), -85.05112878, 85.05112878)
+    return (np.radians(lon) * _EARTH_RADIUS,
+            np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * _EARTH_RADIUS)
+
+def _mercator_to_world_px(x, y, zoom):
+    """EPSG:3857 -> 该缩放级别下的全局像素坐标 (y 轴向上)。"""
+    scale = TILE_SIZE * 2 ** zoom / (2 * _MERCATOR_HALF_WORLD)
+    return (np.asarray(x) + _MERCATOR_HALF_WORLD) * scale, (np.asarray(y) + _MERCATOR_HALF_WORLD) * scale
+
+def _world_px_to_mercator(px, py, zoom):
+    scale = TILE_SIZE * 2 ** zoom / (2 * _MERCATOR_HALF_WORLD)
+    return np.asarray(px) / scale - _MERCATOR_HALF_WORLD, np.asarray(py) / scale - _MERCATOR_HALF_WORLD
+
+def tile_bounds_mercator(zoom, x, y):
+    """XYZ 瓦片 (y 从北向南递增) 的 EPSG:3857 范围 (xmin, ymin, xmax, ymax)。"""
+    size = 2 * _MERCATOR_HALF_WORLD / 2 ** zoom
+    xmin = -_MERCATOR_HALF_WORLD + x * size
+    ymax = _MERCATOR_HALF_WORLD - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+def tiles_for_view(zoom):
+    """覆盖 MAP_VIEW_XLIM/YLIM 的全部瓦片 (zoom, x, y)。"""
+    (x0, x1), (y0, y1) = lonlat_to_mercator(MAP_VIEW_XLIM, MAP_VIEW_YLIM)
+    n = 2 ** zoom
+    size = 2 * _MERCATOR_HALF_WORLD / n
+    tx0, tx1 = int((x0 + _MERCATOR_HALF_WORLD) // size), int((x1 + _MERCATOR_HALF_WORLD) // size)
+    ty0, ty1 = int((_MERCATOR_HALF_WORLD - y1) // size), int((_MERCATOR_HALF_WORLD - y0) // size)
+    return [(zoom, tx, ty) for tx in range(max(tx0, 0), min(tx1, n - 1) + 1)
+            for ty in range(max(ty0, 0), min(ty1, n - 1) + 1)]
+
+def _tile_lod_tolerance(zoom):
+    """该缩放级别的简化容差 (EPSG:3857 米)。Web 墨卡托坐标中每个像素的大小在整个缩放级别内相同。"""
+    units_per_pixel = 2 * _MERCATOR_HALF_WORLD / (TILE_SIZE * 2 ** zoom)
+    return float(2.0 ** np.floor(np.log2(units_per_pixel * BASEMAP_LOD_PIXEL_TOLERANCE)))
+
+def _layout_tile_labels(cities_x, cities_y, names, types, font_prop, zoom):
+    """在整个缩放级别的全局像素空间中布局标签，保证跨瓦片的标签位置一致。"""
+    from matplotlib.backends.backend_agg import RendererAgg
+    styles = city_label_styles()
+    px_per_pt = TILE_DPI / 72.0
+    px, py = _mercator_to_world_px(cities_x, cities_y, zoom)
+    sizes_px, _ = measure_label_sizes(RendererAgg(TILE_SIZE, TILE_SIZE, TILE_DPI), TILE_DPI, names, types, font_prop, styles)
+    (vx0, vx1), (vy0, vy1) = lonlat_to_mercator(MAP_VIEW_XLIM, MAP_VIEW_YLIM)
+    bx, by = _mercator_to_world_px([vx0, vx1], [vy0, vy1], zoom)
+    lower_left, rings = place_labels(np.column_stack((px, py)), sizes_px,
+                                     np.array([styles[t][5] for t in types]),
+                                     np.array([np.sqrt(styles[t][4]) / 2 * px_per_pt for t in types]),
+                                     (bx[0], by[0], bx[1], by[1]), LABEL_MARKER_GAP_PT * px_per_pt)
+    placed = rings >= 0
+    llx, lly = _world_px_to_mercator(lower_left[placed, 0], lower_left[placed, 1], zoom)
+    urx, ury = _world_px_to_mercator(lower_left[placed, 0] + sizes_px[placed, 0],
+                                     lower_left[placed, 1] + sizes_px[placed, 1], zoom)
+    return {'names': [n for n, keep in zip(names, placed) if keep], 'types': types[placed],
+            'boxes': np.column_stack((llx, lly, urx, ury))}
+
+def _init_tile_worker(state):
+    global _tile_worker_state
+    _tile_worker_state = state
+
+def _render_tile(job):
+    """渲染单个瓦片并保存，内存占用只与瓦片大小有关。"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    zoom, x, y, out_path = job
+    state = _tile_worker_state
+    japan_gdf, prefectures_gdf = state['layers'][zoom]
+    xmin, ymin, xmax, ymax = tile_bounds_mercator(zoom, x, y)
+    pad = (xmax - xmin) * 0.05
+
+    fig = Figure(figsize=(TILE_SIZE / TILE_DPI, TILE_SIZE / TILE_DPI), dpi=TILE_DPI)
+    canvas = FigureCanvasAgg(fig)
+    fig.patch.set_alpha(0)
+    ax = fig.add_axes([0, 0, 1, 1])
+    ax.set_axis_off()
+    japan_part = japan_gdf.cx[xmin - pad:xmax + pad, ymin - pad:ymax + pad]
+    prefectures_part = (prefectures_gdf.cx[xmin - pad:xmax + pad, ymin - pad:ymax + pad]
+                        if prefectures_gdf is not None else None)
+    if not japan_part.empty:
+        plot_basemap_layers(ax, japan_part, prefectures_part, verbose=False)
+
+    cities = state['cities']
+    # 标记可能跨瓦片边界，按最大标记半径向外扩展选取
+    near = ((cities['x'] >= xmin - pad) & (cities['x'] <= xmax + pad) &
+            (cities['y'] >= ymin - pad) & (cities['y'] <= ymax + pad))
+    for city_type, (marker, face, edge, lw, size, zorder, _) in city_marker_styles().items():
+        mask = near & (cities['types'] == city_type)
+        if mask.any():
+            ax.scatter(cities['x'][mask], cities['y'][mask], marker=marker, facecolors=face,
+                       edgecolors=edge, linewidths=lw, s=size, zorder=zorder)
+
+    labels = state['labels'].get(zoom)
+    if labels is not None and len(labels['boxes']):
+        boxes = labels['boxes']
+        hit = (boxes[:, 0] < xmax) & (boxes[:, 2] > xmin) & (boxes[:, 1] < ymax) & (boxes[:, 3] > ymin)
+        styles = city_label_styles()
+        for i in np.flatnonzero(hit):
+            fontsize, color, effects, _, _, _ = styles[labels['types'][i]]
+            ax.text(boxes[i, 0], boxes[i, 1], labels['names'][i], fontsize=fontsize, color=color,
+                    fontproperties=_label_font_properties(state['font_prop'], fontsize),
+                    path_effects=effects, ha='left', va='bottom', zorder=STAYED_CITY_LABEL_ZORDER)
+
+    ax.set_xlim(xmin, xmax)
+    ax.set_ylim(ymin, ymax)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    fig.savefig(out_path, dpi=TILE_DPI, transparent=True)
+    return zoom, x, y
+
+def export_tile_pyramid(shapefile_path, prefectures_shapefile_path, all_cities_gdf, font_prop,
+                        output_dir=None, zoom_levels=None, workers=None):
+    """把地图导出为 XYZ 瓦片金字塔 (默认输出到 TILE_OUTPUT_DIR)。返回 (渲染数, 未变化跳过数, 空瓦片跳过数)。"""
+    output_dir = TILE_OUTPUT_DIR if output_dir is None else output_dir
+    zoom_levels = list(zoom_levels if zoom_levels is not None else TILE_ZOOM_LEVELS)
+
+    # 1. 每个缩放级别的底图 (转换到 EPSG:3857 后按该级分辨率简化，两步的结果都会缓存)
+    layers = {}
+    for zoom in zoom_levels:
+        tolerance = _tile_lod_tolerance(zoom)
+        japan_gdf = load_japan_country_gdf(shapefile_path, simplify_tolerance=tolerance, crs="EPSG:3857")
+        prefectures_gdf = None
+        if prefectures_shapefile_path:
+            try:
+                prefectures_gdf = load_japan_prefectures_gdf(prefectures_shapefile_path,
+                                                             simplify_tolerance=tolerance, crs="EPSG:3857")
+            except Exception as e:
+                print(f"错误: 加载或处理都道府县数据 '{prefectures_shapefile_path}' 时失败: {e}")
+        layers[zoom] = (japan_gdf, prefectures_gdf)
+
+    # 2. 城市坐标与每个缩放级别的标签布局
+    cities_x, cities_y = lonlat_to_mercator(all_cities_gdf['longitude'], all_cities_gdf['latitude'])
+    types = all_cities_gdf['type'].to_numpy()
+    cities = {'x': cities_x, 'y': cities_y, 'types': types}
+    label_types = ['stayed'] + (['visited'] if VISITED_CITY_LABEL_ENABLED else [])
+    labelled = np.isin(types, label_types)
+    names = [label_display_name(n) for n in all_cities_gdf['name'][labelled]]
+    labels = {zoom: _layout_tile_labels(cities_x[labelled], cities_y[labelled], names, types[labelled], font_prop, zoom)
+              for zoom in zoom_levels}
+
+    # 3. 计算每个瓦片的内容指纹，跳过纯海洋瓦片和内容未变化的瓦片
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        manifest = {}
+    style = repr((MAP_LAND_COLOR, MAP_OUTLINE_COLOR, MAP_OUTLINE_LINEWIDTH, PREFECTURES_EDGE_COLOR,
+                  PREFECTURES_LINEWIDTH, TILE_SIZE, TILE_DPI, city_label_styles_key(), city_marker_styles_key(),
+                  font_prop.get_fontconfig_pattern() if font_prop else None))
+    new_manifest = {}
+    jobs = []
+    skipped_empty = skipped_unchanged = 0
+    for zoom in zoom_levels:
+        japan_gdf, prefectures_gdf = layers[zoom]
+        base_key = style + repr((_gdf_fingerprint(japan_gdf), _gdf_fingerprint(prefectures_gdf)))
+        land = shapely.union_all(japan_gdf.geometry.values)
+        shapely.prepare(land)
+        tiles = tiles_for_view(zoom)
+        tile_boxes = shapely.box(*np.array([tile_bounds_mercator(*t) for t in tiles]).T)
+        has_land = shapely.intersects(land, tile_boxes)
+        for (z, x, y), tile_has_land in zip(tiles, has_land):
+            xmin, ymin, xmax, ymax = tile_bounds_mercator(z, x, y)
+            pad = (xmax - xmin) * 0.05
+            near = ((cities_x >= xmin - pad) & (cities_x <= xmax + pad) &
+                    (cities_y >= ymin - pad) & (cities_y <= ymax + pad))
+            boxes = labels[zoom]['boxes']
+            label_hit = (boxes[:, 0] < xmax) & (boxes[:, 2] > xmin) & (boxes[:, 1] < ymax) & (boxes[:, 3] > ymin)
+            if not tile_has_land and not near.any() and not label_hit.any():
+                skipped_empty += 1
+                continue
+            content = (base_key, np.round(cities_x[near]).tolist(), np.round(cities_y[near]).tolist(),
+                       types[near].tolist(), [labels[zoom]['names'][i] for i in np.flatnonzero(label_hit)],
+                       np.round(boxes[label_hit]).tolist())
+            digest = hashlib.sha1(repr(content).encode('utf-8')).hexdigest()
+            tile_key = f"{z}/{x}/{y}"
+            new_manifest[tile_key] = digest
+            out_path = os.path.join(output_dir, str(z), str(x), f"{y}.png")
+            if manifest.get(tile_key) == digest and os.path.exists(out_path):
+                skipped_unchanged += 1
+                continue
+            jobs.append((z, x, y, out_path))
+
+    # 4. 多进程渲染。fork 可用时子进程直接共享预加载的数据，否则通过 initializer 传入
+    print(f"瓦片: 需要渲染 {len(jobs)} 个，未变化跳过 {skipped_unchanged} 个，空瓦片跳过 {skipped_empty} 个。")
+    state = {'layers': layers, 'cities': cities, 'labels': labels, 'font_prop': font_prop}
+    if jobs:
+        with _process_pool(_init_tile_worker, (state,), workers or TILE_WORKERS) as pool:
+            for _ in pool.imap_unordered(_render_tile, jobs, chunksize=8):
+                pass
+
+    # 不再需要的旧瓦片 (例如变成空瓦片) 从目录中删除
+    for tile_key in set(manifest) - set(new_manifest):
+        stale_path = os.path.join(output_dir, *tile_key.split('/')) + ".png"
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+    os.makedirs(output_dir, exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(new_manifest, f)
+    os.replace(tmp_path, manifest_path)
+    print(f"瓦片金字塔已导出到: {output_dir}")
+    return len(jobs), skipped_unchanged, skipped_empty
+
+# --- 旅行动画导出 ---
+_animation_worker_state = None  # 渲染进程共享的数据 (静态底图位图、城市、路线、标签布局)
+
+def _init_animation_worker(state):
+    global _animation_worker_state
+    _animation_worker_state = state
+
+def _animation_frame_state(frame, route_length):
+    """第 frame 帧: 返回 (已到达的路线点数, 正在前往的下一个点的进度 0~1)。第 0 帧即显示出发城市。"""
+    leg, step = divmod(frame, ANIMATION_FRAMES_PER_CITY)
+    if leg >= route_length - 1:
+        return route_length, 0.0
+    return leg + 1, step / ANIMATION_FRAMES_PER_CITY
+
+def _render_animation_frames(frame_range):
+    """渲染一段连续的帧，每帧保存为 PNG。底图只画一次，之后每帧恢复背景并只重绘变化的图层 (blit)。"""
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection, PathCollection
+    from PIL import Image
+    state = _animation_worker_state
+    fig = Figure(figsize=MAP_FIGURE_SIZE, dpi=ANIMATION_DPI)
+    canvas = FigureCanvasAgg(fig)
+    fig.figimage(state['background'], zorder=0)
+    ax = fig.add_axes(state['axes_bounds'])
+    ax.set_axis_off()
+    set_map_view(ax)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+
+    # 都道府县边界先叠加到陆地上作为未到访时的背景；到访状态改变时在陆地上重画填色和边界，保存为新的背景
+    fills = edges = None
+    if state['prefecture_paths'] is not None:
+        fills = PathCollection(state['prefecture_paths'], facecolors='none', edgecolors='none', linewidths=0,
+                               zorder=(1 + PREFECTURES_ZORDER) / 2, animated=True)
+        edges = PathCollection(state['prefecture_paths'], facecolors='none', edgecolors=PREFECTURES_EDGE_COLOR,
+                               linewidths=PREFECTURES_LINEWIDTH, zorder=PREFECTURES_ZORDER, animated=True)
+        ax.add_collection(fills, autolim=False)
+        ax.add_collection(edges, autolim=False)
+        land_background = background
+        ax.draw_artist(edges)
+        background = unvisited_background = canvas.copy_from_bbox(fig.bbox)
+    fill_colors = {'stayed': PREFECTURE_STAYED_FILL_COLOR, 'visited': PREFECTURE_VISITED_FILL_COLOR, None: 'none'}
+    drawn_status = None
+
+    route_line, = ax.plot([], [], color=ANIMATION_ROUTE_COLOR, linewidth=ANIMATION_ROUTE_LINEWIDTH,
+                          zorder=(PREFECTURES_ZORDER + VISITED_CITY_MARKER_ZORDER) / 2, animated=True)
+    scatters = {city_type: ax.scatter([], [], marker=marker, facecolors=face, edgecolors=edge, linewidths=lw,
+                                      s=size, zorder=zorder, animated=True)
+                for city_type, (marker, face, edge, lw, size, zorder, _) in city_marker_styles().items()}
+    labels = state['labels']  # 城市序号 -> 布局记录
+    texts = dict(zip(labels, draw_label_layout(ax, [dict(entry, leader=None) for entry in labels.values()],
+                                               state['font_prop'])))
+    for text in texts.values():
+        text.set_animated(True)
+    leaders = LineCollection([], colors='grey', linewidths=1, zorder=3.5, animated=True)
+    ax.add_collection(leaders)
+
+    route_xy, route_city = state['route_xy'], state['route_city']
+    city_xy, city_types = state['city_xy'], state['city_types']
+    paths = []
+    for frame in range(*frame_range):
+        arrived, progress = _animation_frame_state(frame, len(route_xy))
+        line = route_xy[:arrived]
+        if progress and arrived:
+            line = np.vstack([line, line[-1] + (route_xy[arrived] - line[-1]) * progress])
+        shown = np.unique(route_city[:arrived])
+
+        if fills is not None:
+            status = _visit_status_from_assignment(state['city_prefecture'][shown], city_types[shown],
+                                                   len(state['prefecture_paths']))
+            if tuple(status) != drawn_status:
+                drawn_status = tuple(status)
+                if any(drawn_status):
+                    canvas.restore_region(land_background)
+                    fills.set_facecolors([fill_colors[visit_status] for visit_status in status])
+                    ax.draw_artist(fills)
+                    ax.draw_artist(edges)
+                    background = canvas.copy_from_bbox(fig.bbox)
+                else:
+                    background = unvisited_background
+        canvas.restore_region(background)
+        route_line.set_data(line[:, 0], line[:, 1])
+        ax.draw_artist(route_line)
+        for city_type, scatter in scatters.items():
+            scatter.set_offsets(city_xy[shown[city_types[shown] == city_type]].reshape(-1, 2))
+            ax.draw_artist(scatter)
+        leaders.set_segments([[labels[i]['leader'][1:3], labels[i]['leader'][3:5]] for i in shown
+                              if i in labels and labels[i]['leader']])
+        ax.draw_artist(leaders)
+        for i in shown:
+            if i in texts:
+                ax.draw_artist(texts[i])
+
+        path = os.path.join(state['frame_dir'], f"frame_{frame:05d}.png")
+        Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1) \
+            .convert('RGB').save(path, compress_level=1)
+        paths.append(path)
+    return paths
+
+def _geometry_path(geometry):
+    """把 (Multi)Polygon 转换为 matplotlib Path (外环逆时针、内环顺时针，使孔洞不被填充)。"""
+    from matplotlib.path import Path
+    from shapely.geometry.polygon import orient
+    if geometry is None or geometry.is_empty:
+        return Path(np.empty((0, 2)))
+    polygons = [orient(polygon) for polygon in getattr(geometry, 'geoms', [geometry]) if not polygon.is_empty]
+    rings = [ring for polygon in polygons for ring in (polygon.exterior, *polygon.interiors)]
+    return Path.make_compound_path(*[Path(np.asarray(ring.coords)[:, :2], closed=True) for ring in rings])
+
+def _trip_route(all_cities_gdf, trip_order):
+    """把访问顺序转换为城市序号列表，忽略没有坐标的城市。"""
+    index_by_name = {name: i for i, name in enumerate(all_cities_gdf['name'])}
+    missing = [name for name in trip_order if name not in index_by_name]
+    if missing:
+        print(f"警告: 以下城市没有坐标，动画中将跳过: {missing}")
+    return np.array([index_by_name[name] for name in trip_order if name in index_by_name], dtype=np.int64)
+
+def _is_frame_sequence_output(output):
+    return output.endswith(('/', os.sep)) or not os.path.splitext(output)[1]
+
+def check_animation_output(output):
+    """检查能否输出 output (取决于扩展名和是否安装了 ffmpeg)，不能时返回错误信息，否则返回 None。"""
+    if _is_frame_sequence_output(output):
+        return None
+    extension = os.path.splitext(output)[1].lower()
+    if extension in ('.gif', '.png') or (extension in ('.mp4', '.webm') and shutil.which('ffmpeg')):
+        return None
+    if extension in ('.mp4', '.webm'):
+        return f"输出 {extension} 需要 ffmpeg，但未找到。请安装 ffmpeg，或改用 .gif/.png/帧序列目录"
+    return f"不支持的动画格式 '{extension}'，可用: .mp4/.webm (需要 ffmpeg)、.gif、.png 或帧序列目录"
+
+def _open_animation_encoder(output, size):
+    """返回 (写入一帧的函数, 结束时调用的函数)。帧为 PNG 文件路径，写入后删除。"""
+    import subprocess
+    from PIL import Image
+    extension = os.path.splitext(output)[1].lower()
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg and extension in ('.mp4', '.webm', '.gif'):
+        # 原始 RGB 帧通过管道逐帧交给 ffmpeg，主进程同一时间只持有一帧
+        codec = {'.mp4': ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2'],
+                 '.webm': ['-c:v', 'libvpx-vp9'],
+                 '.gif': ['-vf', 'split[a][b];[a]palettegen[p];[b][p]paletteuse']}[extension]
+        process = subprocess.Popen([ffmpeg, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                                    '-s', f"{size[0]}x{size[1]}", '-r', str(ANIMATION_FPS), '-i', '-',
+                                    *codec, output], stdin=subprocess.PIPE)
+
+        def write(path):
+            with Image.open(path) as image:
+                process.stdin.write(image.convert('RGB').tobytes())
+            os.remove(path)
+
+        def close():
+            process.stdin.close()
+            if process.wait() != 0:
+                raise RuntimeError(f"ffmpeg 编码失败 (返回值 {process.returncode})")
+        return write, close
+
+    if extension in ('.gif', '.png'):
+        # Pillow 的多帧编码需要先收集全部帧；转换为调色板图像以减少内存占用
+        print("提示: 未找到 ffmpeg，使用 Pillow 编码 (需要在内存中保存全部帧)。")
+        frames = []
+
+        def write(path):
+            with Image.open(path) as image:
+                frames.append(image.convert('RGB').quantize(colors=255))
+            os.remove(path)
+
+        def close():
+            if frames:
+                frames[0].save(output, save_all=True, append_images=frames[1:], loop=0,
+                               duration=int(1000 / ANIMATION_FPS), **({'optimize': False} if extension == '.gif' else {}))
+        return write, close
+    raise ValueError(f"无法输出 '{output}': 需要 ffmpeg，或改用 .gif/.png/帧序列目录")
+
+def export_trip_animation(japan_gdf, prefectures_gdf, all_cities_gdf, font_prop, output, trip_order=None, workers=None):
+    """导出旅行动画，返回帧数 (失败时为 0)。"""
+    # 在渲染任何帧、创建临时目录之前检查输出格式
+    output_error = check_animation_output(output)
+    if output_error:
+        print(f"错误: {output_error}。")
+        return 0
+    trip_order = trip_order or TRIP_ORDER or list(dict.fromkeys(list(CITIES_STAYED) + list(CITIES_VISITED)))
+    route_city = _trip_route(all_cities_gdf, trip_order)
+    if not len(route_city):
+        print("错误: 访问顺序中没有任何有坐标的城市，无法生成动画。")
+        return 0
+    map_cities_gdf = project_cities_gdf(all_cities_gdf)
+
+    # 1. 按正式图的版式确定坐标轴位置，并用全部城市计算一次标签布局 (每个城市出现后标签位置不再变化)
+    with config_overrides({'MAP_OUTPUT_DPI': ANIMATION_DPI, 'POINT_CLUSTER_ENABLED': False}):
+        fig, ax = plt.subplots(1, 1, figsize=MAP_FIGURE_SIZE, dpi=ANIMATION_DPI)
+        ax.set_aspect(_geographic_aspect(prefectures_gdf if prefectures_gdf is not None and not prefectures_gdf.empty
+                                         else japan_gdf))
+        set_map_view(ax)
+        ax.set_axis_off()
+        plt.tight_layout(pad=0.5)
+        shown_gdf = map_cities_gdf.iloc[np.unique(route_city)]
+        _, _, obstacles_px = draw_city_markers(ax, shown_gdf, font_prop)
+        layout = layout_city_labels_grid(ax, shown_gdf, font_prop, obstacles_px)
+        ax.apply_aspect()
+        axes_bounds = ax.get_position().bounds
+        plt.close(fig)
+        # 填色时静态底图只含陆地 (否则第 0 帧起整条路线的都道府县都显示为已到访)，
+        # 都道府县的填色和边界由渲染进程按到访进度叠加
+        choropleth = PREFECTURE_CHOROPLETH_ENABLED and prefectures_gdf is not None and not prefectures_gdf.empty
+        background = get_static_basemap_layer(tuple(MAP_FIGURE_SIZE), axes_bounds, ANIMATION_DPI, japan_gdf,
+                                              None if choropleth else prefectures_gdf, verbose=not choropleth)
+    index_by_text = {}
+    for i in np.unique(route_city):
+        index_by_text.setdefault(label_display_name(all_cities_gdf['name'].iloc[i]), i)
+    labels = {index_by_text[entry['text']]: entry for entry in layout if entry['text'] in index_by_text}
+
+    # 2. 帧按连续区间分给多个进程渲染 (每个进程只画一次底图)，主进程按顺序逐帧编码
+    # 路线画完后的帧都与最后一帧相同，作为结尾停留
+    frame_count = (len(route_city) - 1) * ANIMATION_FRAMES_PER_CITY + 1 + int(ANIMATION_HOLD_SECONDS * ANIMATION_FPS)
+    ranges = [(start, min(start + ANIMATION_FRAMES_PER_TASK, frame_count))
+              for start in range(0, frame_count, ANIMATION_FRAMES_PER_TASK)]
+    frame_sequence = _is_frame_sequence_output(output)
+    frame_dir = output if frame_sequence else tempfile.mkdtemp(prefix="trip_frames_")
+    os.makedirs(frame_dir, exist_ok=True)
+    xy = np.column_stack((map_cities_gdf.geometry.x.to_numpy(), map_cities_gdf.geometry.y.to_numpy()))
+    state = {'background': background, 'axes_bounds': axes_bounds, 'font_prop': font_prop, 'labels': labels,
+             'prefecture_paths': [_geometry_path(geometry) for geometry in prefectures_gdf.geometry] if choropleth else None,
+             'city_prefecture': assign_prefectures(all_cities_gdf, prefectures_gdf) if choropleth else None,
+             'route_xy': xy[route_city], 'route_city': route_city, 'city_xy': xy,
+             'city_types': all_cities_gdf['type'].to_numpy(), 'frame_dir': frame_dir}
+    print(f"正在渲染 {frame_count} 帧动画 ({len(route_city)} 个城市)...")
+    write = close = None
+    try:
+        if not frame_sequence:
+            write, close = _open_animation_encoder(output, (background.shape[1], background.shape[0]))
+        with _process_pool(_init_animation_worker, (state,), workers or ANIMATION_WORKERS) as pool:
+            for paths in pool.imap(_render_animation_frames, ranges):
+                if write:
+                    for path in paths:
+                        write(path)
+        if close:
+            close()
+    except (OSError, RuntimeError, ValueError) as e:
+        print(f"错误: 导出动画 '{output}' 时失败: {e}")
+        return 0
+    finally:
+        if not frame_sequence:
+            shutil.rmtree(frame_dir, ignore_errors=True)
+    print(f"动画已保存为: {output}")
+    return frame_count
+
+# --- 主要绘图函数 ---
+def draw_japan_map_with_cities(shapefile_path, prefectures_gdf, all_cities_gdf, font_prop, output_filename="japan_map_with_cities.png",
+                               japan_gdf=None):
+    """绘制并保存地图，成功时返回 True。japan_gdf 可传入已加载的国家图层 (批量渲染时预加载)。"""
+    try:
+        if japan_gdf is None:
+            japan_gdf = load_japan_country_gdf(shapefile_path, simplify_tolerance=basemap_lod_tolerance())
+        if japan_gdf.empty:
+            print("错误: 未能在国家 Shapefile 中找到 'Japan' 的数据。")
+            return False
+
+        fig, ax = plt.subplots(1, 1, figsize=MAP_FIGURE_SIZE)
+        fig.patch.set_facecolor(BACKGROUND_COLOR)
+        ax.set_facecolor(BACKGROUND_COLOR)
+        # 所有图层都以 aspect=None 绘制，纵横比只在这里按底图设置一次，
+        # 以免后绘制的图层改变比例，使已经布局好的标签错位
+        ax.set_aspect(_geographic_aspect(prefectures_gdf if prefectures_gdf is not None and not prefectures_gdf.empty else japan_gdf))
+
+        set_map_view(ax)
+
+        if PREFECTURE_CHOROPLETH_ENABLED and prefectures_gdf is not None and not prefectures_gdf.empty:
+            with trace_span("prefecture_join", cities=len(all_cities_gdf)):
+                prefectures_gdf = prefectures_gdf.assign(
+                    visit_status=prefecture_visit_status(all_cities_gdf, prefectures_gdf))
+
+        # 先去掉刻度和边框并确定版式，之后的图例在坐标轴内部，不再改变坐标轴位置；
+        # 这样点的聚合和内置标签布局使用的像素坐标与最终图像一致
         ax.set_xticks([])
         ax.set_yticks([])
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
-        ax.spines['bottom'].set_visible(False)
-        ax.spines['left'].set_visible(False)
-
-        minx, miny, maxx, maxy = japan_gdf.total_bounds
-        ax.set_xlim(MAP_VIEW_XLIM)
-        ax.set_ylim(MAP_VIEW_YLIM)
-
-        handles, labels = ax.get_legend_handles_labels()
-        if handles: # 只有当有label的plot元素时才显示图例
-             ax.legend(handles, labels,
-                       loc='lower right',               # 将图例的“右下角”作为锚点
-                       bbox_to_anchor=(0.75, 0.2),     # 将此锚点放置在坐标轴的 (x=97%, y=3%) 位置
-                                                       # (0,0)是轴的左下角, (1,1)是轴的右上角
-                                                       # 您可以调整 (0.97, 0.03) 这两个值，
-                                                       # 例如 (0.95, 0.05) 会更靠内一些
-                       fontsize='large',               # 将字体调大
-                       frameon=True,                   # 保持无边框
-                       prop=font_prop,                  # 继续使用指定的日文字体属性
-                       markerscale=1.5,                 # 将图例中的标记放大1.5倍
-                       labelspacing=0.8,                # 调整条目间的垂直间距 (可选)
-                       handletextpad=0.5,               # 调整标记和文本的间距 (可选)
-                    #    title='图例',                    # 可选：为图例添加标题
-                    #    title_fontproperties=font_prop   # 图例标题也使用同样的字体属性
-                      )
-
+        for spine in ax.spines.values():
+            spine.set_visible(False)
         plt.tight_layout(pad=0.5)
-        plt.savefig(output_filename, dpi=500, facecolor=fig.get_facecolor())
+
+        # 绘制城市标记 (每个类别一个散点集合，点过密时按网格聚合)
+        # labelable_gdf: 需要标签的城市 (聚合簇内的点不单独加标签)；marker_points: 各类别实际绘制的标记位置；
+        # obstacles_px: 所有标记和聚合数量文字的像素框
+        with trace_span("plot_markers", cities=len(all_cities_gdf)):
+            labelable_gdf, marker_points, obstacles_px = draw_city_markers(ax, project_cities_gdf(all_cities_gdf), font_prop)
+
+        with trace_span("label_layout", engine=LABEL_PLACEMENT_ENGINE, labels=len(labelable_gdf)):
+            cache_key = label_layout_cache_key(labelable_gdf, marker_points, font_prop) if LABEL_LAYOUT_CACHE_ENABLED else None
+            layout = load_label_layout(cache_key) if cache_key else None
+            if layout is None:
+                if LABEL_PLACEMENT_ENGINE == "grid":
+                    layout = layout_city_labels_grid(ax, labelable_gdf, font_prop, obstacles_px)
+                else:
+                    layout = layout_city_labels_adjusttext(ax, labelable_gdf, marker_points, font_prop)
+                if cache_key:
+                    save_label_layout(cache_key, layout)
+            else:
+                trace_count("label_layout_cache_hits")
+            draw_label_layout(ax, layout, font_prop)
+
+        use_static_layer = (STATIC_LAYER_CACHE_ENABLED and
+                            os.path.splitext(output_filename)[1].lower() in STATIC_LAYER_OUTPUT_FORMATS)
+        if not use_static_layer:
+            with trace_span("plot_basemap"):
+                plot_basemap_layers(ax, japan_gdf, prefectures_gdf)
+
+        with trace_span("legend_layout"):
+            handles, labels = ax.get_legend_handles_labels()
+            if handles: # 只有当有label的plot元素时才显示图例
+                 ax.legend(handles, labels,
+                           loc='lower right',               # 将图例的“右下角”作为锚点
+                           bbox_to_anchor=(0.75, 0.2),     # 将此锚点放置在坐标轴的 (x=97%, y=3%) 位置
+                                                           # (0,0)是轴的左下角, (1,1)是轴的右上角
+                                                           # 您可以调整 (0.97, 0.03) 这两个值，
+                                                           # 例如 (0.95, 0.05) 会更靠内一些
+                           fontsize='large',               # 将字体调大
+                           frameon=True,                   # 保持无边框
+                           prop=font_prop,                  # 继续使用指定的日文字体属性
+                           markerscale=1.5,                 # 将图例中的标记放大1.5倍
+                           labelspacing=0.8,                # 调整条目间的垂直间距 (可选)
+                           handletextpad=0.5,               # 调整标记和文本的间距 (可选)
+                        #    title='图例',                    # 可选：为图例添加标题
+                        #    title_fontproperties=font_prop   # 图例标题也使用同样的字体属性
+                          )
+
+        # 版式已在绘制标记前确定，这里不再调用 tight_layout (超出坐标轴的标签会使它再次移动坐标轴)
+        with trace_span("encode", output=output_filename, dpi=MAP_OUTPUT_DPI, static_layer=use_static_layer):
+            if use_static_layer:
+                save_composited_map(fig, ax, japan_gdf, prefectures_gdf, output_filename, MAP_OUTPUT_DPI)
+            else:
+                plt.savefig(output_filename, dpi=MAP_OUTPUT_DPI, facecolor=fig.get_facecolor())
         print(f"地图已保存为: {output_filename}")
+        plt.close(fig)
+        return True
         # plt.show()
 
     except FileNotFoundError:
@@ -361,105 +2156,790 @@ def draw_japan_map_with_cities(shapefile_path, prefectures_gdf, all_cities_gdf,
         print(f"绘制地图时发生错误: {e}")
         import traceback
         traceback.print_exc()
+    return False
 
-if __name__ == "__main__":
-    if SHAPEFILE_PATH == "path/to/your/ne_50m_admin_0_countries.shp": # 检查默认占位符
-        print("请先修改脚本顶部的 'SHAPEFILE_PATH' 变量。")
-    elif not JAPANESE_FONT_NAME:
-        print("请在脚本顶部配置 'JAPANESE_FONT_NAME' 以正确显示日文标签。")
+# --- 数据准备 ---
+def load_prefectures_for_map(prefectures_shapefile_path=None, simplify_tolerance=None, crs=None, clip=True):
+    """加载日本都道府县图层 (默认为 PREFECTURES_SHAPEFILE_PATH)，失败或未配置时返回 None。
+
+    覆盖统计使用 clip=False 的图层，显示范围外的城市也能归属到都道府县。
+    """
+    prefectures_shapefile_path = PREFECTURES_SHAPEFILE_PATH if prefectures_shapefile_path is None else prefectures_shapefile_path
+    japan_prefectures_gdf = None
+    if prefectures_shapefile_path and prefectures_shapefile_path != r"path\to\your\japan_prefectures.shp":
+        try:
+            print(f"正在加载都道府县数据从: {prefectures_shapefile_path}")
+            japan_prefectures_gdf = load_japan_prefectures_gdf(prefectures_shapefile_path,
+                                                               simplify_tolerance=simplify_tolerance, crs=crs, clip=clip)
+
+            if japan_prefectures_gdf.empty:
+                print(f"警告: 从 '{prefectures_shapefile_path}' 中未能筛选出日本的都道府县数据。")
+                japan_prefectures_gdf = None #确保设置为空，如果筛选失败
+
+        except Exception as e:
+            print(f"错误: 加载或处理都道府县数据 '{prefectures_shapefile_path}' 时失败: {e}")
+            japan_prefectures_gdf = None
+    else:
+        print("提示: 未配置有效的都道府县数据文件路径 ('PREFECTURES_SHAPEFILE_PATH')。")
+    return japan_prefectures_gdf
+
+def build_cities_gdf(location_cache, geocoders, cities_stayed=None, cities_visited=None, resolve=None):
+    """解析城市坐标 (默认为 CITIES_STAYED/CITIES_VISITED) 并生成绘图用的 GeoDataFrame (name, latitude, longitude, type)。
+    resolve(城市名) 可替换默认的 resolve_city_coordinates (例如逐个加锁)。没有任何有效坐标时返回 None。"""
+    cities_stayed = CITIES_STAYED if cities_stayed is None else cities_stayed
+    cities_visited = CITIES_VISITED if cities_visited is None else cities_visited
+    resolve = resolve or (lambda city_name: resolve_city_coordinates(city_name, location_cache, geocoders))
+    all_cities_data_list = []
+    processed_names = set()
+
+    # 1. 处理住宿过的城市
+    for city_name in cities_stayed:
+        if city_name in processed_names: continue
+        coords = resolve(city_name)
+        if coords:
+            all_cities_data_list.append({'name': city_name, 'latitude': coords[0], 'longitude': coords[1], 'type': 'stayed'})
+            processed_names.add(city_name)
+        else:
+            print(f"无法获取 '{city_name}' (住宿) 的坐标。")
+
+    # 2. 处理仅旅游过的城市
+    for city_name in cities_visited:
+        if city_name in processed_names:
+            print(f"'{city_name}' 已作为住宿地处理，跳过旅游地标记。")
+            continue
+        coords = resolve(city_name)
+        if coords:
+            all_cities_data_list.append({'name': city_name, 'latitude': coords[0], 'longitude': coords[1], 'type': 'visited'})
+            processed_names.add(city_name)
+        else:
+            print(f"无法获取 '{city_name}' (旅游) 的坐标。")
+
+    if not all_cities_data_list:
+        return None
+    return make_cities_gdf(pd.DataFrame(all_cities_data_list))
+
+# --- 位置历史导入 ---
+def _parse_timestamp(text):
+    """ISO 8601 时间字符串转为 UTC 秒数。"""
+    value = datetime.datetime.fromisoformat(text.strip().replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value.timestamp()
+
+def iter_gpx_fixes(path):
+    """流式读取 GPX，逐个产生 (UTC 秒数, 纬度, 经度)。没有时间的点被跳过。"""
+    point_tags = ('trkpt', 'rtept', 'wpt')
+    stack = []
+    for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+        if event == 'start':
+            stack.append(elem)
+            continue
+        stack.pop()
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if tag in point_tags:
+            time_elem = next((child for child in elem if child.tag.rsplit('}', 1)[-1] == 'time'), None)
+            if time_elem is not None and time_elem.text:
+                try:
+                    yield _parse_timestamp(time_elem.text), float(elem.get('lat')), float(elem.get('lon'))
+                except (TypeError, ValueError):
+                    pass
+        # 处理完的元素立即从父节点移除，保持内存占用不随文件大小增长 (定位点的子元素留到定位点结束时再处理)
+        if stack and stack[-1].tag.rsplit('}', 1)[-1] not in point_tags:
+            stack[-1].remove(elem)
+
+def _iter_json_array_items(f, key, chunk_size=1 << 20):
+    """流式读取 JSON 文件中顶层 key 对应的数组 (或顶层数组本身) 的各个元素。"""
+    decoder = json.JSONDecoder()
+    buf, pos = f.read(chunk_size), 0
+    first = buf.lstrip()[:1]
+    if first != '[':
+        marker = f'"{key}"'
+        while True:
+            found = buf.find(marker)
+            if found >= 0:
+                pos = buf.find('[', found)
+                if pos >= 0:
+                    break
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError(f"没有找到 '{key}' 数组")
+            buf = buf[-len(marker):] + chunk if found < 0 else buf[found:] + chunk
     else:
-        font_properties = get_font_properties(JAPANESE_FONT_NAME)
-        location_cache = load_location_cache(LOCATION_CACHE_FILE)
-        cache_updated = False
+        pos = buf.index('[')
+    pos += 1
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(buf):
+            chunk = f.read(chunk_size)
+            if not chunk:
+                raise ValueError("JSON 数组不完整")
+            buf, pos = chunk, 0
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError:
+            chunk = f.read(chunk_size)  # 元素跨越了读取块的边界
+            if not chunk:
+                raise
+            buf, pos = buf[pos:] + chunk, 0
+            continue
+        yield item
+        pos = end
+        if pos > chunk_size:
+            buf, pos = buf[pos:], 0
+
+def iter_location_records_fixes(path):
+    """流式读取 Google 位置记录 (Records.json)，逐个产生 (UTC 秒数, 纬度, 经度)。"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for record in _iter_json_array_items(f, 'locations'):
+            try:
+                if record.get('accuracy', 0) > HISTORY_MAX_ACCURACY_M:
+                    continue
+                if 'timestamp' in record:
+                    timestamp = _parse_timestamp(record['timestamp'])
+                else:
+                    timestamp = int(record['timestampMs']) / 1000
+                yield timestamp, record['latitudeE7'] / 1e7, record['longitudeE7'] / 1e7
+            except (KeyError, TypeError, ValueError):
+                continue
+
+def iter_location_history_fixes(path):
+    if path.lower().endswith('.gpx'):
+        return iter_gpx_fixes(path)
+    return iter_location_records_fixes(path)
+
+def _is_japanese_name(name):
+    return any('\u3040' <= ch <= '\u30ff' or '\u4e00' <= ch <= '\u9fff' for ch in name)
+
+def load_snap_places(gazetteer, min_population=None):
+    """从离线地名库取出可吸附的居民点 (人口至少 min_population，默认为 HISTORY_MIN_POPULATION)，
+    返回 DataFrame (name, latitude, longitude)。
+
+    地名库中每个别名各占一行，这里按坐标合并，同一地点优先使用最短的日文名称。
+    """
+    min_population = HISTORY_MIN_POPULATION if min_population is None else min_population
+    rows = gazetteer.conn.execute(
+        "SELECT name, latitude, longitude, population FROM places WHERE is_populated = 1 AND population >= ?",
+        (min_population,)).fetchall()
+    df = pd.DataFrame(rows, columns=['name', 'latitude', 'longitude', 'population'])
+    df['rank'] = ~df['name'].map(_is_japanese_name)
+    df['name_length'] = df['name'].str.len()
+    df = df.sort_values(['rank', 'name_length', 'name'])
+    return df.drop_duplicates(['latitude', 'longitude', 'population'])[['name', 'latitude', 'longitude']].reset_index(drop=True)
+
+def _spans_overnight(start, end):
+    """[start, end] (UTC 秒数) 是否包含当地时间凌晨 HISTORY_OVERNIGHT_HOUR 点。"""
+    offset = (HISTORY_UTC_OFFSET_HOURS - HISTORY_OVERNIGHT_HOUR) * 3600
+    return math.floor((end + offset) / 86400) >= math.ceil((start + offset) / 86400)
+
+def cities_gdf_from_location_history(paths, gazetteer, chunk_size=50000):
+    """读取位置历史文件，按停留时间推断住宿/旅游过的城市。返回与 build_cities_gdf 相同格式的 GeoDataFrame，没有结果时返回 None。
+
+    定位点按块吸附 (STRtree 最近邻查询)，只保留每个地点的累计结果，内存占用与文件大小无关。
+    """
+    places = load_snap_places(gazetteer)
+    if places.empty:
+        print("错误: 离线地名库中没有可用于吸附的居民点。")
+        return None
+    # 在日本范围内近似使用等距投影 (经度按 36 度纬度缩放)，距离单位为度
+    lon_scale = math.cos(math.radians(36))
+    tree = shapely.STRtree(shapely.points(places['longitude'].to_numpy() * lon_scale, places['latitude'].to_numpy()))
+    max_distance = HISTORY_SNAP_RADIUS_KM / 111.32
+    max_gap = HISTORY_MAX_GAP_HOURS * 3600
+    dwell = {}  # 地点序号 -> [累计停留秒数, 是否住宿]
+
+    def finish_run(place, start, end):
+        if place < 0:
+            return
+        seconds = end - start
+        stayed = seconds >= HISTORY_STAY_MIN_HOURS * 3600 and _spans_overnight(start, end)
+        entry = dwell.setdefault(place, [0.0, False])
+        entry[0] += seconds
+        entry[1] = entry[1] or stayed
+
+    for path in paths:
+        print(f"正在读取位置历史: {path}")
+        fix_count = 0
+        run = None  # 当前未结束的停留 (地点序号, 开始, 结束)，跨块延续
+        fixes = iter_location_history_fixes(path)
+        while True:
+            chunk = np.array(list(itertools.islice(fixes, chunk_size)), dtype=float).reshape(-1, 3)
+            if not len(chunk):
+                break
+            fix_count += len(chunk)
+            timestamps = chunk[:, 0]
+            snapped = np.full(len(chunk), -1)
+            fix_index, place_index = tree.query_nearest(shapely.points(chunk[:, 2] * lon_scale, chunk[:, 1]),
+                                                        max_distance=max_distance, all_matches=False)
+            snapped[fix_index] = place_index
+            # 按 (地点变化 或 间隔过长) 切分为连续停留段
+            breaks = np.flatnonzero((snapped[1:] != snapped[:-1]) | (np.abs(np.diff(timestamps)) > max_gap)) + 1
+            for start, end in zip(np.r_[0, breaks], np.r_[breaks, len(chunk)]):
+                place = snapped[start]
+                t0, t1 = timestamps[start:end].min(), timestamps[start:end].max()
+                if run and run[0] == place and abs(t0 - run[2]) <= max_gap:
+                    run = (place, min(run[1], t0), max(run[2], t1))
+                else:
+                    if run:
+                        finish_run(*run)
+                    run = (place, t0, t1)
+        if run:
+            finish_run(*run)
+        print(f"  共 {fix_count} 个定位点。")
+
+    rows = []
+    for place, (seconds, stayed) in dwell.items():
+        if stayed or seconds >= HISTORY_VISIT_MIN_MINUTES * 60:
+            row = places.iloc[place]
+            rows.append({'name': row['name'], 'latitude': row['latitude'], 'longitude': row['longitude'],
+                         'type': 'stayed' if stayed else 'visited'})
+    if not rows:
+        return None
+    print(f"从位置历史中识别出 {sum(r['type'] == 'stayed' for r in rows)} 个住宿地、"
+          f"{sum(r['type'] == 'visited' for r in rows)} 个旅游地。")
+    return make_cities_gdf(pd.DataFrame(rows))
+
+def merge_cities_gdfs(*gdfs):
+    """合并多个城市 GeoDataFrame，同名城市只保留一个 (住宿优先于旅游)。全部为空时返回 None。"""
+    gdfs = [gdf for gdf in gdfs if gdf is not None and not gdf.empty]
+    if not gdfs:
+        return None
+    merged = pd.concat(gdfs, ignore_index=True)
+    merged = merged.sort_values('type', key=lambda types: types != 'stayed', kind='stable')
+    return geopandas.GeoDataFrame(merged.drop_duplicates('name').sort_index().reset_index(drop=True), crs=gdfs[0].crs)
+
+# --- 批量渲染 ---
+_batch_worker_state = None  # 渲染进程共享的预加载数据 (任务列表、底图、字体)
 
-        # 新增：加载都道府县数据
-        japan_prefectures_gdf = None
-        if PREFECTURES_SHAPEFILE_PATH and PREFECTURES_SHAPEFILE_PATH != r"path\to\your\japan_prefectures.shp":
+def check_config_keys(settings):
+    """检查覆盖项都是本模块已有的大写配置项，否则抛出 KeyError。"""
+    module_globals = globals()
+    for key in settings:
+        if not key.isupper() or key not in module_globals:
+            raise KeyError(f"未知的配置项 '{key}'")
+
+@contextlib.contextmanager
+def config_overrides(settings):
+    """临时覆盖本模块的大写配置项，退出时恢复。"""
+    module_globals = globals()
+    check_config_keys(settings)
+    saved = {key: module_globals[key] for key in settings}
+    try:
+        for key, value in settings.items():
+            module_globals[key] = tuple(value) if isinstance(value, list) and isinstance(saved[key], tuple) else value
+        yield
+    finally:
+        module_globals.update(saved)
+
+def load_batch_configs(path):
+    """读取批量配置，返回 [(名称, 配置目录, 配置 dict 或读取时的异常), ...]。"""
+    entries = []
+    if os.path.isdir(path):
+        for file_name in sorted(os.listdir(path)):
+            if not file_name.endswith('.json'):
+                continue
+            file_path = os.path.join(path, file_name)
+            name = os.path.splitext(file_name)[0]
             try:
-                print(f"正在加载都道府县数据从: {PREFECTURES_SHAPEFILE_PATH}")
-                all_admin1_gdf = geopandas.read_file(PREFECTURES_SHAPEFILE_PATH)
-                
-                # 如果使用的是 Natural Earth 的全球 Admin 1 文件，需要筛选出日本的都道府县
-                # Natural Earth 的 'ne_10m_admin_1_states_provinces.shp' 文件中
-                # 通常有 'adm0_a3' (ISO 3166-1 alpha-3 国家代码) 或 'admin' (国家名) 列
-                # 请根据您下载的文件的实际列名进行调整
-                # 例如，检查: print(all_admin1_gdf.columns)
-                # 然后取消注释并修改下面的行
-                if 'adm0_a3' in all_admin1_gdf.columns: # 适用于 Natural Earth
-                    japan_prefectures_gdf = all_admin1_gdf[all_admin1_gdf['adm0_a3'] == 'JPN']
-                elif 'SOV_A3' in all_admin1_gdf.columns and 'ADMIN' in all_admin1_gdf.columns: # 另一种 Natural Earth 可能的列组合
-                     japan_prefectures_gdf = all_admin1_gdf[all_admin1_gdf['SOV_A3'] == 'JPN'] # 或者 ADMIN == 'Japan'
-                # 如果您下载的是 GADM 提供的日本专用 Level 1 文件 (如 gadm41_JPN_1.shp)
-                # 则该文件本身就只包含日本的都道府县，无需此处的筛选步骤
-                #可以直接 japan_prefectures_gdf = all_admin1_gdf
-                else: # 假设是日本专用文件，或需要用户确认如何筛选
-                    print("警告: 未能自动从都道府县文件中筛选日本数据。如果这是全球数据，请修改脚本中的筛选逻辑。如果这是日本专用数据，此警告可忽略。")
-                    japan_prefectures_gdf = all_admin1_gdf # 直接使用，假设是日本专用
-
-                if japan_prefectures_gdf.empty:
-                    print(f"警告: 从 '{PREFECTURES_SHAPEFILE_PATH}' 中未能筛选出日本的都道府县数据。")
-                    japan_prefectures_gdf = None #确保设置为空，如果筛选失败
+                with open(file_path, 'r', encoding='utf-8') as f:
+                    config = json.load(f)
+                entries.append((config.get('name', name), path, config))
+            except Exception as e:
+                entries.append((name, path, e))
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        configs = manifest['maps'] if isinstance(manifest, dict) else manifest
+        base_dir = os.path.dirname(os.path.abspath(path))
+        for i, config in enumerate(configs):
+            entries.append((config.get('name', f"map_{i + 1}"), base_dir, config))
+    return entries
+
+def preload_render_resources(fonts, basemaps):
+    """按当前配置 (可在 config_overrides 内调用) 准备字体和底图，已加载的直接复用。返回 (字体键, 底图键)。"""
+    if JAPANESE_FONT_NAME not in fonts:
+        fonts[JAPANESE_FONT_NAME] = get_font_properties(JAPANESE_FONT_NAME)
+    basemap_key = (SHAPEFILE_PATH, PREFECTURES_SHAPEFILE_PATH, tuple(MAP_VIEW_XLIM), tuple(MAP_VIEW_YLIM),
+                   MAP_OUTPUT_CRS, basemap_lod_tolerance())
+    if basemap_key not in basemaps:
+        basemaps[basemap_key] = (
+            load_japan_country_gdf(SHAPEFILE_PATH, simplify_tolerance=basemap_lod_tolerance()),
+            load_prefectures_for_map(PREFECTURES_SHAPEFILE_PATH, simplify_tolerance=basemap_lod_tolerance()))
+    return JAPANESE_FONT_NAME, basemap_key
+
+def _init_batch_worker(state):
+    global _batch_worker_state
+    _batch_worker_state = state
+
+def _render_batch_job(index):
+    """渲染一张批量地图。返回 (序号, 是否成功, 耗时秒数, 错误信息)。"""
+    job = _batch_worker_state['jobs'][index]
+    start = time.perf_counter()
+    try:
+        japan_gdf, prefectures_gdf = _batch_worker_state['basemaps'][job['basemap_key']]
+        with config_overrides(job['settings']):
+            ok = draw_japan_map_with_cities(SHAPEFILE_PATH, prefectures_gdf, job['cities_gdf'],
+                                            _batch_worker_state['fonts'][job['font_name']],
+                                            output_filename=job['output'], japan_gdf=japan_gdf)
+        error = None if ok else "绘图失败 (详见上方输出)"
+    except Exception as e:
+        ok, error = False, f"{type(e).__name__}: {e}"
+    finally:
+        plt.close('all')
+    return index, ok, time.perf_counter() - start, error
+
+def run_batch(path, workers=None):
+    """批量渲染多张地图，返回每张地图的结果 [(名称, 是否成功, 耗时秒数, 错误信息), ...]。"""
+    entries = load_batch_configs(path)
+    results = {}
+    jobs = []
+    basemaps = {}
+    fonts = {}
 
+    # 1. 主进程内一次性准备: 字体、地理编码 (共享同一个缓存)、每种显示范围/分辨率对应的底图
+    location_cache = open_location_cache(LOCATION_CACHE_DB, LOCATION_CACHE_FILE)
+    geocoders = build_geocoders()
+    try:
+        for name, base_dir, config in entries:
+            start = time.perf_counter()
+            try:
+                if isinstance(config, Exception):
+                    raise config
+                settings = config.get('settings', {})
+                with config_overrides(settings):
+                    font_name, basemap_key = preload_render_resources(fonts, basemaps)
+                    cities_gdf = build_cities_gdf(location_cache, geocoders,
+                                                  config.get('cities_stayed', []), config.get('cities_visited', []))
+                if cities_gdf is None:
+                    raise ValueError("未能获取任何有效的城市坐标")
+                output = os.path.join(base_dir, config.get('output', f"{name}.png"))
+                jobs.append({'name': name, 'settings': settings, 'cities_gdf': cities_gdf, 'output': output,
+                             'basemap_key': basemap_key, 'font_name': font_name})
             except Exception as e:
-                print(f"错误: 加载或处理都道府县数据 '{PREFECTURES_SHAPEFILE_PATH}' 时失败: {e}")
-                japan_prefectures_gdf = None
+                results[name] = (False, time.perf_counter() - start, f"准备失败: {type(e).__name__}: {e}")
+    finally:
+        location_cache.close()
+
+    # 2. 多进程渲染。fork 可用时子进程直接共享上面准备好的数据
+    if jobs:
+        print(f"开始批量渲染 {len(jobs)} 张地图...")
+        state = {'jobs': jobs, 'basemaps': basemaps, 'fonts': fonts}
+        with _process_pool(_init_batch_worker, (state,), workers or BATCH_WORKERS) as pool:
+            for index, ok, seconds, error in pool.imap_unordered(_render_batch_job, range(len(jobs))):
+                results[jobs[index]['name']] = (ok, seconds, error)
+                print(f"[{'完成' if ok else '失败'}] {jobs[index]['name']} ({seconds:.2f} 秒)")
+
+    report = [(name, *results[name]) for name, _, _ in entries if name in results]
+    print("\n批量渲染结果:")
+    for name, ok, seconds, error in report:
+        print(f"  {name}: {'成功' if ok else '失败'}  {seconds:.2f} 秒" + (f"  ({error})" if error else ""))
+    return report
+
+# --- 渲染服务 ---
+_server_worker_state = None  # 渲染进程共享的预加载数据 (字体、底图)，fork 时继承
+
+# 渲染请求可以覆盖的配置项及取值规则，其它配置项 (文件路径、缓存目录、字体、进程数等) 请求不能修改
+_COLOR_RULE, _BOOL_RULE, _LINEWIDTH_RULE = ('color',), ('bool',), ('number', 0, 20)
+_SERVER_SETTING_RULES = {
+    'BACKGROUND_COLOR': _COLOR_RULE, 'MAP_LAND_COLOR': _COLOR_RULE, 'MAP_OUTLINE_COLOR': _COLOR_RULE,
+    'MAP_OUTLINE_LINEWIDTH': _LINEWIDTH_RULE,
+    'STAYED_CITY_MARKER_FACE_COLOR': _COLOR_RULE, 'STAYED_CITY_MARKER_EDGE_COLOR': _COLOR_RULE,
+    'STAYED_CITY_MARKER_SIZE': ('number', 0, 1000), 'STAYED_CITY_MARKER_LINEWIDTH': _LINEWIDTH_RULE,
+    'STAYED_CITY_LABEL_COLOR': _COLOR_RULE, 'STAYED_CITY_LABEL_FONTSIZE': ('number', 1, 72),
+    'STAYED_CITY_LABEL_OUTLINE_COLOR': _COLOR_RULE, 'STAYED_CITY_LABEL_OUTLINE_WIDTH': _LINEWIDTH_RULE,
+    'VISITED_CITY_MARKER_SHAPE': ('choice', ('o', 's', '^', 'v', 'D', 'd', '*', '.', 'x', '+', 'P', 'X', 'h', 'p')),
+    'VISITED_CITY_MARKER_FACE_COLOR': _COLOR_RULE, 'VISITED_CITY_MARKER_EDGE_COLOR': _COLOR_RULE,
+    'VISITED_CITY_MARKER_SIZE': ('number', 0, 1000), 'VISITED_CITY_MARKER_LINEWIDTH': _LINEWIDTH_RULE,
+    'VISITED_CITY_LABEL_ENABLED': _BOOL_RULE, 'VISITED_CITY_LABEL_COLOR': _COLOR_RULE,
+    'VISITED_CITY_LABEL_FONTSIZE': ('number', 1, 72), 'VISITED_CITY_LABEL_OUTLINE_COLOR': _COLOR_RULE,
+    'VISITED_CITY_LABEL_OUTLINE_WIDTH': _LINEWIDTH_RULE,
+    'PREFECTURES_EDGE_COLOR': _COLOR_RULE, 'PREFECTURES_LINEWIDTH': _LINEWIDTH_RULE,
+    'PREFECTURE_CHOROPLETH_ENABLED': _BOOL_RULE, 'PREFECTURE_STAYED_FILL_COLOR': _COLOR_RULE,
+    'PREFECTURE_VISITED_FILL_COLOR': _COLOR_RULE,
+    'MAP_VIEW_XLIM': ('range', 100, 180), 'MAP_VIEW_YLIM': ('range', 0, 60), 'MAP_OUTPUT_CRS': ('crs',),
+    'MAP_FIGURE_SIZE': ('size', 1, 40), 'MAP_OUTPUT_DPI': ('number', 10, 1200),
+    'LABEL_PLACEMENT_ENGINE': ('choice', ('grid', 'adjusttext')), 'LABEL_CANDIDATE_RINGS': ('int', 1, 5),
+    'LABEL_MARKER_GAP_PT': ('number', 0, 20), 'POINT_CLUSTER_ENABLED': _BOOL_RULE,
+}
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def check_server_settings(settings):
+    """检查渲染请求的配置覆盖项 (只允许 _SERVER_SETTING_RULES 中的项，并检查类型和范围)，不合法时抛出 ValueError。"""
+    from matplotlib.colors import is_color_like
+    if not isinstance(settings, dict):
+        raise ValueError("settings 必须是 JSON 对象")
+    for key, value in settings.items():
+        rule = _SERVER_SETTING_RULES.get(key)
+        if rule is None:
+            raise ValueError(f"配置项 '{key}' 不允许由请求修改")
+        kind = rule[0]
+        if kind == 'color':
+            valid = isinstance(value, str) and is_color_like(value)
+        elif kind == 'bool':
+            valid = isinstance(value, bool)
+        elif kind == 'number':
+            valid = _is_number(value) and rule[1] <= value <= rule[2]
+        elif kind == 'int':
+            valid = isinstance(value, int) and not isinstance(value, bool) and rule[1] <= value <= rule[2]
+        elif kind == 'choice':
+            valid = value in rule[1]
+        elif kind in ('range', 'size'):
+            valid = (isinstance(value, list) and len(value) == 2 and all(_is_number(v) for v in value) and
+                     all(rule[1] <= v <= rule[2] for v in value) and (kind == 'size' or value[0] < value[1]))
+        else:  # 'crs': 只接受 EPSG 代码，避免 PROJ 字符串引用服务端文件
+            valid = isinstance(value, str) and value.upper().startswith('EPSG:') and value[5:].isdigit()
+            if valid:
+                try:
+                    _crs_info(value.upper())
+                except Exception:
+                    valid = False
+        if not valid:
+            raise ValueError(f"配置项 '{key}' 的取值无效: {value!r}")
+    figure_size = settings.get('MAP_FIGURE_SIZE', MAP_FIGURE_SIZE)
+    dpi = settings.get('MAP_OUTPUT_DPI', MAP_OUTPUT_DPI)
+    if figure_size[0] * figure_size[1] * dpi * dpi > SERVER_MAX_OUTPUT_PIXELS:
+        raise ValueError(f"输出图像过大 ({figure_size[0]}×{figure_size[1]} 英寸, {dpi} dpi)，"
+                         f"上限为 {SERVER_MAX_OUTPUT_PIXELS} 像素")
+
+def _check_city_list(request, key):
+    cities = request.get(key, [])
+    if not isinstance(cities, list) or not all(isinstance(name, str) for name in cities):
+        raise ValueError(f"{key} 必须是字符串列表")
+    return cities
+
+def _init_server_worker(state):
+    global _server_worker_state
+    _server_worker_state = state
+
+def _render_server_job(job):
+    """在渲染进程中绘制一张地图。返回 (是否成功, 图片内容或错误信息, 耗时秒数)。"""
+    start = time.perf_counter()
+    fd, output = tempfile.mkstemp(suffix='.' + job['format'])
+    os.close(fd)
+    try:
+        # 请求的样式/范围组合任意，渲染结果不写入磁盘缓存 (预加载的默认底图不受影响)
+        with config_overrides(dict(job['settings'], BASEMAP_CACHE_DIR=None)):
+            # 设置改变了字体或底图范围时在本进程内加载一次，之后的请求复用
+            font_name, basemap_key = preload_render_resources(_server_worker_state['fonts'],
+                                                              _server_worker_state['basemaps'])
+            japan_gdf, prefectures_gdf = _server_worker_state['basemaps'][basemap_key]
+            ok = draw_japan_map_with_cities(SHAPEFILE_PATH, prefectures_gdf, make_cities_gdf(pd.DataFrame(job['cities'])),
+                                            _server_worker_state['fonts'][font_name],
+                                            output_filename=output, japan_gdf=japan_gdf)
+        if not ok:
+            return False, "绘图失败 (详见服务端输出)", time.perf_counter() - start
+        with open(output, 'rb') as f:
+            return True, f.read(), time.perf_counter() - start
+    except Exception as e:
+        # 详细错误 (可能包含服务端路径) 只写入服务端输出，不返回给客户端
+        print(f"渲染请求失败: {type(e).__name__}: {e}")
+        return False, "绘图失败 (详见服务端输出)", time.perf_counter() - start
+    finally:
+        plt.close('all')
+        if os.path.exists(output):
+            os.remove(output)
+
+class RenderServer:
+    """常驻渲染服务: 预加载资源后创建渲染进程池，render() 可被多个请求线程同时调用。"""
+
+    def __init__(self, workers=None):
+        self.started_at = time.time()
+        self.fonts, self.basemaps = {}, {}
+        print("正在预加载字体、位置缓存、地理编码器和底图...")
+        preload_render_resources(self.fonts, self.basemaps)
+        self.location_cache = open_location_cache(LOCATION_CACHE_DB, LOCATION_CACHE_FILE)
+        # 请求只使用离线后端: 在线查询每个地名可能耗时十几秒，会阻塞其它请求
+        self.geocoders = build_geocoders([name for name in GEOCODER_BACKENDS if name != "nominatim"])
+        self.geocode_lock = threading.Lock()  # 位置缓存连接要求串行，每个地名单独加锁
+        self.pending = threading.BoundedSemaphore(SERVER_MAX_PENDING)
+        self.metrics_lock = threading.Lock()
+        self.counters = {'requests': 0, 'succeeded': 0, 'failed': 0, 'rejected': 0, 'in_flight': 0}
+        self.latencies = collections.deque(maxlen=1000)  # 最近请求的 (总耗时, 地理编码耗时, 渲染耗时)
+        self.workers = workers or SERVER_WORKERS or os.cpu_count() or 1
+        self.pool = _process_pool(_init_server_worker, ({'fonts': self.fonts, 'basemaps': self.basemaps},), self.workers)
+        print(f"渲染进程池已启动 ({self.workers} 个进程)。")
+
+    def render(self, request):
+        """处理一个渲染请求 (dict)。返回 (HTTP 状态码, Content-Type, 响应内容)。"""
+        if not self.pending.acquire(blocking=False):
+            with self.metrics_lock:
+                self.counters['rejected'] += 1
+            return 503, 'application/json', {'error': "排队的请求过多，请稍后重试"}
+        start = time.perf_counter()
+        with self.metrics_lock:
+            self.counters['requests'] += 1
+            self.counters['in_flight'] += 1
+        try:
+            status, content_type, body, geocode_seconds, render_seconds = self._render(request)
+        except Exception as e:
+            print(f"处理渲染请求时出错: {type(e).__name__}: {e}")
+            status, content_type, body = 500, 'application/json', {'error': "服务端内部错误 (详见服务端输出)"}
+            geocode_seconds = render_seconds = 0.0
+        finally:
+            self.pending.release()
+        with self.metrics_lock:
+            self.counters['in_flight'] -= 1
+            self.counters['succeeded' if status == 200 else 'failed'] += 1
+            self.latencies.append((time.perf_counter() - start, geocode_seconds, render_seconds))
+        return status, content_type, body
+
+    def _render(self, request):
+        try:
+            settings = request.get('settings', {})
+            check_server_settings(settings)
+            if settings.get('MAP_OUTPUT_CRS'):
+                settings = dict(settings, MAP_OUTPUT_CRS=settings['MAP_OUTPUT_CRS'].upper())
+            output_format = request.get('format', 'png')
+            if not isinstance(output_format, str) or output_format.lower() not in SERVER_OUTPUT_FORMATS:
+                raise ValueError(f"不支持的输出格式 {output_format!r}，可用: {list(SERVER_OUTPUT_FORMATS)}")
+            output_format = output_format.lower()
+            cities_stayed = _check_city_list(request, 'cities_stayed')
+            cities_visited = _check_city_list(request, 'cities_visited')
+            city_count = len(cities_stayed) + len(cities_visited)
+            if city_count > SERVER_MAX_CITIES:
+                raise ValueError(f"城市数超过上限 {SERVER_MAX_CITIES}")
+            if (settings.get('LABEL_PLACEMENT_ENGINE', LABEL_PLACEMENT_ENGINE) == 'adjusttext'
+                    and city_count > SERVER_MAX_ADJUSTTEXT_CITIES):
+                raise ValueError(f"使用 adjustText 布局时城市数不能超过 {SERVER_MAX_ADJUSTTEXT_CITIES}")
+        except ValueError as e:
+            return 400, 'application/json', {'error': str(e)}, 0.0, 0.0
+
+        geocode_start = time.perf_counter()
+        cities_gdf = build_cities_gdf(self.location_cache, self.geocoders, cities_stayed, cities_visited,
+                                      resolve=self._resolve_city)
+        geocode_seconds = time.perf_counter() - geocode_start
+        resolved = set() if cities_gdf is None else set(cities_gdf['name'])
+        unresolved = [name for name in dict.fromkeys(cities_stayed + cities_visited) if name not in resolved]
+        if unresolved:
+            return 400, 'application/json', {'error': "无法解析以下城市的坐标", 'cities': unresolved}, geocode_seconds, 0.0
+
+        job = {'settings': settings, 'format': output_format,
+               'cities': cities_gdf[['name', 'latitude', 'longitude', 'type']].to_dict('records')}
+        try:
+            ok, result, render_seconds = self.pool.apply_async(_render_server_job, (job,)).get(SERVER_RENDER_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            return 504, 'application/json', {'error': f"渲染超过 {SERVER_RENDER_TIMEOUT} 秒"}, geocode_seconds, 0.0
+        if not ok:
+            return 500, 'application/json', {'error': result}, geocode_seconds, render_seconds
+        return 200, SERVER_OUTPUT_FORMATS[output_format], result, geocode_seconds, render_seconds
+
+    def _resolve_city(self, city_name):
+        with self.geocode_lock:  # 只在单个地名的查询期间持有锁，其它请求可以穿插进行
+            return resolve_city_coordinates(city_name, self.location_cache, self.geocoders)
+
+    def health(self):
+        return {'status': 'ok', 'uptime_seconds': round(time.time() - self.started_at, 1), 'workers': self.workers}
+
+    def metrics(self):
+        with self.metrics_lock:
+            counters = dict(self.counters)
+            latencies = np.array(self.latencies) if self.latencies else np.zeros((0, 3))
+        summary = dict(counters, uptime_seconds=round(time.time() - self.started_at, 1), workers=self.workers,
+                       pending_limit=SERVER_MAX_PENDING, window=len(latencies))
+        for column, prefix in enumerate(('latency', 'geocode', 'render')):
+            if len(latencies):
+                values = latencies[:, column]
+                summary[f'{prefix}_seconds'] = {'p50': float(np.percentile(values, 50)),
+                                                'p95': float(np.percentile(values, 95)),
+                                                'max': float(values.max()), 'mean': float(values.mean())}
+        return summary
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+        self.location_cache.close()
+
+class _RenderRequestHandler(http.server.BaseHTTPRequestHandler):
+    """HTTP 接口: POST /render, GET /health, GET /metrics。"""
+
+    def _send(self, status, content_type, body):
+        if content_type == 'application/json':
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            content_type += '; charset=utf-8'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, 'application/json', self.server.render_server.health())
+        elif self.path == '/metrics':
+            self._send(200, 'application/json', self.server.render_server.metrics())
         else:
-            print("提示: 未配置有效的都道府县数据文件路径 ('PREFECTURES_SHAPEFILE_PATH')。")
-
-        
-        all_cities_data_list = []
-        processed_names = set()
-
-        # 1. 处理住宿过的城市
-        for city_name in CITIES_STAYED:
-            if city_name in processed_names: continue
-            coords = None
-            if city_name in location_cache:
-                print(f"从缓存加载 '{city_name}' (住宿)。")
-                coords = (location_cache[city_name]['latitude'], location_cache[city_name]['longitude'])
-            else:
-                coords = get_city_coordinates_from_api(city_name)
-                if coords:
-                    location_cache[city_name] = {'latitude': coords[0], 'longitude': coords[1]}
-                    cache_updated = True
-            
-            if coords:
-                all_cities_data_list.append({'name': city_name, 'latitude': coords[0], 'longitude': coords[1], 'type': 'stayed'})
-                processed_names.add(city_name)
-            else:
-                print(f"无法获取 '{city_name}' (住宿) 的坐标。")
+            self._send(404, 'application/json', {'error': f"未知路径 '{self.path}'"})
 
-        # 2. 处理仅旅游过的城市
-        for city_name in CITIES_VISITED:
-            if city_name in processed_names:
-                print(f"'{city_name}' 已作为住宿地处理，跳过旅游地标记。")
-                continue
-            coords = None
-            if city_name in location_cache:
-                print(f"从缓存加载 '{city_name}' (旅游)。")
-                coords = (location_cache[city_name]['latitude'], location_cache[city_name]['longitude'])
+    def do_POST(self):
+        if self.path != '/render':
+            self._send(404, 'application/json', {'error': f"未知路径 '{self.path}'"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if not 0 <= length <= SERVER_MAX_REQUEST_BYTES:
+            self.close_connection = True  # 请求体未读取，不能复用连接
+            self._send(413 if length > 0 else 400, 'application/json',
+                       {'error': f"Content-Length 无效或超过上限 {SERVER_MAX_REQUEST_BYTES} 字节"})
+            return
+        try:
+            request = json.loads(self.rfile.read(length) or b'{}')
+            if not isinstance(request, dict):
+                raise ValueError("请求体必须是 JSON 对象")
+        except ValueError as e:
+            self._send(400, 'application/json', {'error': f"无效的请求: {e}"})
+            return
+        self._send(*self.server.render_server.render(request))
+
+    def address_string(self):
+        return self.client_address[0] if isinstance(self.client_address, tuple) else 'unix'
+
+if hasattr(socketserver, 'UnixStreamServer'):  # Windows 不支持 Unix socket
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+def serve(address=None, workers=None):
+    """启动渲染服务，address 为 'host:port' 或 'unix:/path/to.sock' (默认为 SERVER_ADDRESS)。阻塞直到 Ctrl+C。"""
+    address = SERVER_ADDRESS if address is None else address
+    render_server = RenderServer(workers)
+    try:
+        if address.startswith('unix:'):
+            if not hasattr(socketserver, 'UnixStreamServer'):
+                raise ValueError("当前系统不支持 Unix socket，请使用 'host:port' 地址")
+            socket_path = address[len('unix:'):]
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            httpd = _UnixHTTPServer(socket_path, _RenderRequestHandler)
+        else:
+            host, _, port = address.rpartition(':')
+            httpd = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)), _RenderRequestHandler)
+    except Exception:
+        render_server.close()  # 地址被占用等情况下也要结束进程池
+        raise
+    httpd.render_server = render_server
+    print(f"渲染服务已启动: {address} (POST /render, GET /health, GET /metrics)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("\n正在停止渲染服务...")
+    finally:
+        httpd.server_close()
+        render_server.close()
+        if address.startswith('unix:') and os.path.exists(address[len('unix:'):]):
+            os.remove(address[len('unix:'):])
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="在日本地图上标记住宿过/旅游过的城市。")
+    parser.add_argument("--tiles", metavar="DIR", nargs="?", const=TILE_OUTPUT_DIR,
+                        help=f"导出 Web 墨卡托 XYZ 瓦片金字塔到 DIR (默认 '{TILE_OUTPUT_DIR}')，而不是单张图片")
+    parser.add_argument("--batch", metavar="PATH",
+                        help="按目录中的 *.json 配置或清单文件批量渲染多张地图")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="--tiles/--batch/--serve 使用的渲染进程数 (默认使用全部 CPU 核心)")
+    parser.add_argument("--serve", metavar="ADDRESS", nargs="?", const=SERVER_ADDRESS,
+                        help=f"作为常驻渲染服务运行，监听 'host:port' 或 'unix:/path' (默认 '{SERVER_ADDRESS}')")
+    parser.add_argument("--check", action="store_true",
+                        help="只解析并检查所有城市的坐标 (使用缓存和地理编码后端)，不绘图；有城市无法解析时返回 1")
+    parser.add_argument("--offline", action="store_true",
+                        help="与 --check 一起使用: 只查位置缓存，不调用任何地理编码后端")
+    parser.add_argument("--refresh-cache", action="store_true",
+                        help="重新地理编码所有城市并更新位置缓存 (包括此前失败的记录)，不绘图")
+    parser.add_argument("--animate", metavar="OUTPUT",
+                        help="按 TRIP_ORDER 的顺序导出旅行动画 (.mp4/.webm/.gif/.png，或以 '/' 结尾的帧序列目录)")
+    parser.add_argument("--draft", action="store_true",
+                        help=f"以 {DRAFT_OUTPUT_DPI} dpi 快速渲染草稿 (*_draft.png)，计算并缓存标签布局，之后的正式渲染直接复用")
+    parser.add_argument("--history", metavar="FILE", nargs="+",
+                        help="从位置历史文件 (GPX 或 Records.json) 推断住宿/旅游过的城市，与脚本中的城市列表合并")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="记录各阶段耗时、内存峰值和计数器 (缓存命中、API 调用等)，保存为 JSON (只统计主进程)")
+    parser.add_argument("--profile-dir", metavar="DIR",
+                        help="另外为每个顶层阶段保存 cProfile 结果 (.prof) 到 DIR，可用 snakeviz 等工具查看")
+    args = parser.parse_args()
+    if args.trace or args.profile_dir:
+        enable_tracing(profile_dir=args.profile_dir)
+    if args.trace:
+        import atexit
+        atexit.register(write_trace, args.trace)  # sys.exit(1) 等提前退出时也保存追踪结果
+
+    if args.serve:
+        serve(args.serve, workers=args.workers)
+    elif args.batch:
+        run_batch(args.batch, workers=args.workers)
+    elif args.check or args.refresh_cache:
+        # 这两个子命令不会导入 geopandas/matplotlib/adjustText
+        location_cache = open_location_cache(LOCATION_CACHE_DB, LOCATION_CACHE_FILE)
+        try:
+            if args.refresh_cache:
+                refresh_location_cache(location_cache, build_geocoders())
             else:
-                coords = get_city_coordinates_from_api(city_name)
-                if coords:
-                    location_cache[city_name] = {'latitude': coords[0], 'longitude': coords[1]}
-                    cache_updated = True
-
-            if coords:
-                all_cities_data_list.append({'name': city_name, 'latitude': coords[0], 'longitude': coords[1], 'type': 'visited'})
-                processed_names.add(city_name)
+                unresolved = check_cities(location_cache, None if args.offline else build_geocoders())
+                if unresolved:
+                    sys.exit(1)
+        finally:
+            location_cache.close()
+    elif SHAPEFILE_PATH == "path/to/your/ne_50m_admin_0_countries.shp": # 检查默认占位符
+        print("请先修改脚本顶部的 'SHAPEFILE_PATH' 变量。")
+    elif not JAPANESE_FONT_NAME:
+        print("请在脚本顶部配置 'JAPANESE_FONT_NAME' 以正确显示日文标签。")
+    else:
+        with trace_span("font_resolution"):
+            font_properties = get_font_properties(JAPANESE_FONT_NAME)
+        location_cache = open_location_cache(LOCATION_CACHE_DB, LOCATION_CACHE_FILE)
+        geocoders = build_geocoders()
+        with trace_span("geocoding"):
+            all_cities_gdf = build_cities_gdf(location_cache, geocoders)
+        all_cached_locations = cached_locations(location_cache)  # 坐标检查也覆盖缓存中未配置的地名
+        location_cache.close()
+        gazetteer = next((g for g in geocoders if g.name == "gazetteer"), None)
+        history_files = args.history or LOCATION_HISTORY_FILES
+        if history_files:
+            if gazetteer is None and not (os.path.exists(GAZETTEER_SOURCE_FILE) or os.path.exists(GAZETTEER_INDEX_FILE)):
+                print(f"错误: 导入位置历史需要离线地名数据 '{GAZETTEER_SOURCE_FILE}'，但未找到。将只使用配置中的城市。")
+                print("提示: 从 https://download.geonames.org/export/dump/JP.zip 下载并解压得到 JP.txt。")
             else:
-                print(f"无法获取 '{city_name}' (旅游) 的坐标。")
-
-        if cache_updated:
-            save_location_cache(LOCATION_CACHE_FILE, location_cache)
+                try:
+                    with trace_span("history_import", files=len(history_files)):
+                        history_gdf = cities_gdf_from_location_history(
+                            history_files, gazetteer or GazetteerGeocoder(GAZETTEER_SOURCE_FILE, GAZETTEER_INDEX_FILE))
+                    all_cities_gdf = merge_cities_gdfs(all_cities_gdf, history_gdf)
+                except Exception as e:
+                    print(f"错误: 导入位置历史时失败: {e}。将只使用配置中的城市。")
 
-        if not all_cities_data_list:
+        if all_cities_gdf is None:
             print("未能获取任何有效的城市坐标，无法继续绘图。")
         else:
-            all_cities_gdf = pd.DataFrame(all_cities_data_list)
-            geometry = [Point(xy) for xy in zip(all_cities_gdf['longitude'], all_cities_gdf['latitude'])]
-            all_cities_gdf = geopandas.GeoDataFrame(all_cities_gdf, geometry=geometry, crs="EPSG:4326")
-
             print("\n最终用于绘图的城市数据:")
             print(all_cities_gdf[['name', 'type', 'latitude', 'longitude']])
-            draw_japan_map_with_cities(SHAPEFILE_PATH, japan_prefectures_gdf, all_cities_gdf, font_properties)
\ No newline at end of file
+            if args.tiles:
+                export_tile_pyramid(SHAPEFILE_PATH, PREFECTURES_SHAPEFILE_PATH, all_cities_gdf, font_properties,
+                                    output_dir=args.tiles, workers=args.workers)
+            elif args.animate:
+                tolerance = basemap_lod_tolerance(dpi=ANIMATION_DPI)
+                frame_count = export_trip_animation(load_japan_country_gdf(SHAPEFILE_PATH, simplify_tolerance=tolerance),
+                                                    load_prefectures_for_map(simplify_tolerance=tolerance),
+                                                    all_cities_gdf, font_properties, args.animate, workers=args.workers)
+                if not frame_count:
+                    sys.exit(1)
+            else:
+                # 新增：加载都道府县数据。国家图层在 draw_japan_map_with_cities 内按当前 DPI 选取容差，
+                # 这里显式传入同一分辨率的容差，使草稿模式下两层的简化程度一致
+                tolerance = basemap_lod_tolerance(dpi=DRAFT_OUTPUT_DPI if args.draft else None)
+                japan_prefectures_gdf = load_prefectures_for_map(simplify_tolerance=tolerance)
+                # 覆盖统计使用未裁剪、未简化的经纬度图层，显示范围外的城市 (如冲绳) 也能正确归属
+                if japan_prefectures_gdf is not None:
+                    report_prefecture_coverage(all_cities_gdf, load_prefectures_for_map(crs="EPSG:4326", clip=False),
+                                               all_cached_locations, gazetteer)
+                if args.draft:
+                    with config_overrides({'MAP_OUTPUT_DPI': DRAFT_OUTPUT_DPI}):
+                        draw_japan_map_with_cities(SHAPEFILE_PATH, japan_prefectures_gdf, all_cities_gdf, font_properties,
+                                                   output_filename="japan_map_with_cities_draft.png")
+                else:
+                    draw_japan_map_with_cities(SHAPEFILE_PATH, japan_prefectures_gdf, all_cities_gdf, font_properties)
+
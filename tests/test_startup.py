@@ -0,0 +1,41 @@
+"""启动回归测试：导入 main 不应加载绘图/地理依赖，且导入耗时应在预算内。"""
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 导入 main 时不应加载的重型模块（只在真正绘图/读取底图时才导入）
+HEAVY_MODULES = ("geopandas", "matplotlib", "pandas", "pyproj", "shapely", "adjustText", "geopy")
+
+# 导入 main 的耗时预算（秒）；正常约 0.1 秒，误引入 geopandas 等会超过数秒
+IMPORT_BUDGET_SECONDS = 1.5
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "modules": sorted(sys.modules)}))
+"""
+
+
+def _import_main():
+    output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], cwd=REPO_DIR,
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_import_main_does_not_load_heavy_modules():
+    loaded = set(_import_main()["modules"])
+    heavy = sorted(name for name in HEAVY_MODULES
+                   if name in loaded or any(module.startswith(name + ".") for module in loaded))
+    assert not heavy, f"导入 main 时加载了重型模块: {heavy}"
+
+
+def test_import_main_within_budget():
+    # 取多次中的最小值，避免冷缓存或机器抖动造成误报
+    seconds = min(_import_main()["seconds"] for _ in range(3))
+    assert seconds < IMPORT_BUDGET_SECONDS, \
+        f"导入 main 耗时 {seconds:.2f} 秒，超过预算 {IMPORT_BUDGET_SECONDS} 秒"